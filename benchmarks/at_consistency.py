@@ -0,0 +1,41 @@
+"""Check that enmap.at gives the same result with and without pol_angle.
+With pol_angle the map is spline-filtered up front and interpolated in
+blocks, while without it the filtering is left to utils.interpol and
+scipy's map_coordinates, so this catches differences in the boundary
+handling of the two paths. The positions are drawn close to the edges of
+the map, where such differences show up, for both a partial-sky map and a
+full-sky map that is interpolated periodically in RA. Exits with a
+non-zero status if any difference is larger than --tol. Run as
+PYTHONPATH=. python benchmarks/at_consistency.py from the top directory."""
+import argparse, sys
+import numpy as np
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--npoint", type=int,   default=10000)
+parser.add_argument("-t", "--tol",    type=float, default=1e-10)
+parser.add_argument("-s", "--seed",   type=int,   default=1)
+args = parser.parse_args()
+from lambda_tools import enmap, utils
+np.random.seed(args.seed)
+
+def edge_coords(n, npoint):
+	"""Pixel coordinates within 2 pixels of either edge of an axis of length n"""
+	off = np.random.uniform(-0.5, 1.5, npoint)
+	return np.where(np.random.uniform(0, 1, npoint) < 0.5, off, n-1-off)
+
+ok = True
+for name, box in [("partial", [[-10,-20],[10,20]]), ("fullsky", [[-80,-180],[80,180]])]:
+	shape, wcs = enmap.geometry(pos=np.array(box)*utils.degree, res=0.5*utils.degree, proj="car")
+	map = enmap.rand_gauss((3,)+shape, wcs)
+	ny, nx = shape
+	pos = np.array([edge_coords(ny, args.npoint), np.random.uniform(-0.5, nx-0.5, args.npoint)])
+	pos[:,::2] = [np.random.uniform(-0.5, ny-0.5, args.npoint//2), edge_coords(nx, args.npoint//2)]
+	for mode in ["nearest", "constant", "mirror"]:
+		for order in [1, 3, 5]:
+			ref = map.at(pos, order=order, mode=mode, unit="pix")
+			res = enmap.at(map, pos, order=order, mode=mode, unit="pix", pol_angle=0, bsize=0x1000)
+			err = np.max(np.abs(res-ref))
+			good= err <= args.tol
+			ok &= good
+			print("%-8s %-9s order %d wrap %-5s maxdiff %.3g %s" % (name, mode, order,
+				enmap.wraps_ra(shape, wcs), err, "ok" if good else "FAIL"))
+sys.exit(0 if ok else 1)
@@ -0,0 +1,45 @@
+"""Measure how long it takes to import the lambda_tools modules, and check
+that none of them pull in heavy optional dependencies at import time.
+Each import is timed in a fresh interpreter, and the best of several runs
+is reported. Exits with a non-zero status if a forbidden module was
+imported, or if an import took longer than --max-time seconds, so it can
+be used to catch startup regressions. lambda_tools must be importable,
+e.g. run as PYTHONPATH=. python benchmarks/import_time.py from the top
+directory."""
+import argparse, subprocess, sys, json
+parser = argparse.ArgumentParser()
+parser.add_argument("modules", nargs="*", default=["lambda_tools.utils", "lambda_tools.wcsutils",
+	"lambda_tools.powspec", "lambda_tools.enmap", "lambda_tools.coordinates", "lambda_tools.curvedsky"])
+parser.add_argument("-n", "--nrep",     type=int,   default=5)
+parser.add_argument("-t", "--max-time", type=float, default=None, help="Fail if any import takes longer than this many seconds.")
+parser.add_argument("-f", "--forbid",   type=str,   default="scipy.ndimage,scipy.optimize,astropy.wcs,astropy.io.fits,astropy.coordinates,sharp,healpy,ephem",
+	help="Comma-separated list of modules that should not be imported")
+parser.add_argument("-p", "--python",   type=str,   default=sys.executable)
+args = parser.parse_args()
+
+code = """
+import time, sys, json
+t1 = time.time()
+import %s
+t2 = time.time()
+print(json.dumps([t2-t1, [m for m in %r if m in sys.modules]]))
+"""
+
+forbid = [m for m in args.forbid.split(",") if m]
+ok     = True
+for module in args.modules:
+	times = []
+	for i in range(args.nrep):
+		out = subprocess.check_output([args.python, "-c", code % (module, forbid)])
+		t, loaded = json.loads(out.decode().strip().split("\n")[-1])
+		times.append(t)
+	t = min(times)
+	status = ""
+	if loaded:
+		status += " imports " + ",".join(loaded)
+		ok = False
+	if args.max_time is not None and t > args.max_time:
+		status += " too slow"
+		ok = False
+	print("%-26s %8.4f s%s" % (module, t, status))
+sys.exit(0 if ok else 1)
@@ -0,0 +1,43 @@
+"""Compare the speed of enmap.sky2pix using wcslib with the closed-form
+native implementation for the plain, CAR and CEA projections. The points
+are generated and transformed in blocks of --block points so that large
+totals like the default 10^8 points fit in memory. Reports the throughput
+of each method, the speedup and the largest difference between them in
+pixels. Run as PYTHONPATH=. python benchmarks/sky2pix.py from the top
+directory."""
+import argparse, time, sys
+import numpy as np
+parser = argparse.ArgumentParser()
+parser.add_argument("projs", nargs="*", default=["car","cea","plain"])
+parser.add_argument("-n", "--npoint", type=float, default=1e8)
+parser.add_argument("-b", "--block",  type=float, default=1e7)
+parser.add_argument("-r", "--res",    type=float, default=0.5, help="Pixel size in arcmin")
+parser.add_argument("-d", "--dtype",  type=str,   default="float64")
+parser.add_argument("-s", "--seed",   type=int,   default=1)
+args = parser.parse_args()
+from lambda_tools import enmap, utils
+
+npoint = int(args.npoint)
+block  = int(args.block)
+dtype  = np.dtype(args.dtype)
+box    = np.array([[-30,-60],[30,60]])*utils.degree
+np.random.seed(args.seed)
+
+for proj in args.projs:
+	shape, wcs = enmap.geometry(pos=box, res=args.res*utils.arcmin, proj=proj)
+	times  = {"wcslib": 0.0, "native": 0.0}
+	maxdiff= 0
+	for i1 in range(0, npoint, block):
+		n = min(block, npoint-i1)
+		# Cover somewhat more than the map, to exercise the wrapping
+		pos = (np.random.uniform(-1.2, 1.2, (2,n))*(box[1]-box[0])[:,None]/2).astype(dtype)
+		res = {}
+		for method in ["wcslib", "native"]:
+			t1 = time.time()
+			res[method] = enmap.sky2pix(shape, wcs, pos, method=method)
+			times[method] += time.time()-t1
+		maxdiff = max(maxdiff, np.max(np.abs(res["native"]-res["wcslib"])))
+		del pos, res
+	print("%-6s %12.2f Mpts/s wcslib %12.2f Mpts/s native %6.2fx speedup maxdiff %.3g pix" % (proj,
+		npoint/times["wcslib"]/1e6, npoint/times["native"]/1e6, times["wcslib"]/times["native"], maxdiff))
+	sys.stdout.flush()
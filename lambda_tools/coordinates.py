@@ -1,10 +1,12 @@
 """This module provides conversions between astronomical coordinate systems.
 When c is more developed, it might completely replace this
 module. For now, it is used as a part of the implementation."""
-import numpy as np
-import astropy.coordinates as c, astropy.units as u
+import numpy as np, os
 from . import utils
 from .utils import ang2rect, rect2ang
+c     = utils.lazy_module("astropy.coordinates")
+u     = utils.lazy_module("astropy.units")
+ephem = utils.lazy_module("ephem")
 # Optional dependencies
 try:
 	from . import pyfsla
@@ -12,10 +14,6 @@ try:
 	from enlib    import iers
 except ImportError:
 	pass
-try:
-	import ephem
-except ImportError:
-	pass
 
 class default_site:
 	lat  = -22.9585
@@ -27,47 +25,75 @@ class default_site:
 	freq = 150.
 	lapse= 0.0065
 
-def transform(from_sys, to_sys, coords, time=55500, site=default_site, pol=None, mag=None):
+def transform(from_sys, to_sys, coords, time=55500, site=default_site, pol=None, mag=None, out=None, bsize=0x10000):
 	"""Transforms coords[2,...] from system from_sys to system to_sys, where
 	systems can be "hor", "cel" or "gal". For transformations involving
 	"hor", the optional arguments time (in modified julian days) and site (which must
 	contain .lat (rad), .lon (rad), .P (pressure, mBar), .T (temperature, K),
 	.hum (humidity, 0.2 by default), .alt (altitude, m)). Returns an array
-	with the same shape as the input. The coordinates are in ra,dec-ordering."""
+	with the same shape as the input. The coordinates are in ra,dec-ordering.
+
+	The result has the same precision as coords (single or double), but
+	the transformation and the polarization angle are computed in double
+	precision, since the latter involves differencing nearby positions.
+
+	The coordinates are processed in blocks of bsize samples, so the
+	temporary memory use does not grow with the size of coords. If out is
+	specified, the result is written there instead of to a new array. out
+	may overlap with coords, e.g. out=coords for an in-place transformation."""
+	coords = np.asarray(coords)
+	time   = np.asarray(time)
+	# Make time per-sample if necessary, so that it can be split into blocks
+	if time.ndim > 0: time = (time + np.zeros(coords.shape[1:],time.dtype)).reshape(-1)
 	from_info, to_info = getsys_full(from_sys,time,site), getsys_full(to_sys,time,site)
 	ihand = get_handedness(from_info[0])
 	ohand = get_handedness(to_info[0])
-	# Apply the specified transformation, optionally computing the induced
-	# polarization rotation and apparent magnification
-	def transfunc(coords):
-		return transform_raw(from_info, to_info, coords, time=time, site=site)
 	fields = []
 	if pol: fields.append("ang")
 	if mag: fields.append("mag")
 	if pol is None and mag is None:
 		if len(coords) > 2: fields.append("ang")
 		if len(coords) > 3: fields.append("mag")
-	meta = transform_meta(transfunc, coords[:2], fields=fields)
-
-	# Fix the polarization convention. We use healpix
-	if "ang" in fields:
-		if ihand != ohand: meta.ang -= np.pi
-		if ohand != 'L':   meta.ang = -meta.ang
+	# Rotations allow us to compute the metadata analytically. Otherwise
+	# fall back on finite differences.
+	R = get_full_rotmat(from_info, to_info)
 	# Create the output array. This is a bit cumbersome because
 	# each of the output columns can be either ang or mag, which
 	# might or might not have previous values that need to be
 	# updated. It is this way to keep backward compatibility.
-	res = np.zeros((2+len(fields),) + meta.ocoord.shape[1:])
-	res[:2] = meta.ocoord
-	off = 2
-	for i, f in enumerate(fields):
-		if f == "ang":
-			if len(coords) > 2: res[off+i] = coords[2] + meta.ang
-			else: res[off+i] = meta.ang
-		elif f == "mag":
-			if len(coords) > 3: res[off+i] = coords[3] * meta.mag
-			else: res[off+i] = meta.mag
-	return res
+	oshape = (2+len(fields),) + coords.shape[1:]
+	if out is None: out = np.empty(oshape, dtype=utils.float_type(coords.dtype))
+	if out.shape != oshape: raise ValueError("out must have shape %s" % str(oshape))
+	cflat = coords.reshape(len(coords),-1)
+	with utils.flatview(np.asarray(out), [0], "rw", pos=1) as oflat:
+		for i1 in range(0, cflat.shape[1], bsize):
+			sel    = slice(i1, i1+bsize)
+			# Copy the input block, since out may overlap with coords
+			icoord = np.array(cflat[:,sel], dtype=np.float64)
+			btime  = time if time.ndim == 0 else time[sel]
+			binfo  = select_info(from_info, sel), select_info(to_info, sel)
+			# Apply the specified transformation, optionally computing the induced
+			# polarization rotation and apparent magnification
+			def transfunc(coords):
+				return transform_raw(binfo[0], binfo[1], coords, time=btime, site=site)
+			if R is not None:
+				meta = transform_meta_rot(transfunc, R, icoord[:2], fields=fields)
+			else:
+				meta = transform_meta(transfunc, icoord[:2], fields=fields)
+			# Fix the polarization convention. We use healpix
+			if "ang" in fields:
+				if ihand != ohand: meta.ang -= np.pi
+				if ohand != 'L':   meta.ang = -meta.ang
+			oflat[:2,sel] = meta.ocoord
+			off = 2
+			for i, f in enumerate(fields):
+				if f == "ang":
+					if len(icoord) > 2: oflat[off+i,sel] = icoord[2] + meta.ang
+					else: oflat[off+i,sel] = meta.ang
+				elif f == "mag":
+					if len(icoord) > 3: oflat[off+i,sel] = icoord[3] * meta.mag
+					else: oflat[off+i,sel] = meta.mag
+	return out
 
 def transform_meta(transfun, coords, fields=["ang","mag"], offset=5e-7):
 	"""Computes metadata for the coordinate transformation functor
@@ -80,7 +106,7 @@ def transform_meta(transfun, coords, fields=["ang","mag"], offset=5e-7):
 	if "mag_brute" in fields: ntrans = 3
 	elif "ang" in fields: ntrans = 2
 	else: ntrans = 1
-	coords  = np.asarray(coords)
+	coords  = np.asarray(coords, dtype=np.float64)
 	offsets = np.array([[0,0],[1,0],[0,1]])*offset
 	# Transform all the coordinates. We assume we aren't super-close to the poles
 	# either before or after the transformation.
@@ -126,7 +152,56 @@ def transform_meta(transfun, coords, fields=["ang","mag"], offset=5e-7):
 		res.mag = (tri_area(diff).T/tri_area(offsets[1:]-offsets[0]).T).T
 	return res
 
-def transform_raw(from_sys, to_sys, coords, time=None, site=None):
+def transform_meta_rot(transfun, R, coords, fields=["ang","mag"], bsize=0x10000):
+	"""Analytic version of transform_meta for the case where transfun is a
+	pure rotation R[3,3] of the sphere. This only needs to call transfun
+	once, and gets the polarization rotation by rotating the local
+	longitude direction of each input point with R and projecting it onto
+	the local longitude and latitude directions of the output point. This
+	follows the same convention as transform_meta, but is more accurate,
+	especially close to the poles."""
+	coords = np.asarray(coords, dtype=np.float64)
+	class Result: pass
+	res = Result()
+	res.icoord = coords
+	res.ocoord = transfun(coords)
+	if "ang" in fields:
+		iflat = coords.reshape(2,-1)
+		oflat = res.ocoord.reshape(2,-1)
+		res.ang = np.empty(iflat.shape[1])
+		for i in range(0, iflat.shape[1], bsize):
+			ilon, ilat = iflat[:,i:i+bsize]
+			olon, olat = oflat[:,i:i+bsize]
+			# The input longitude direction in output cartesian coordinates
+			v = R.dot([-np.sin(ilon), np.cos(ilon), np.zeros(ilon.shape)])
+			# Its components along the output longitude and latitude directions
+			vlon = -v[0]*np.sin(olon) + v[1]*np.cos(olon)
+			vlat = -(v[0]*np.cos(olon) + v[1]*np.sin(olon))*np.sin(olat) + v[2]*np.cos(olat)
+			res.ang[i:i+bsize] = np.arctan2(vlat, vlon)
+		res.ang = res.ang.reshape(coords.shape[1:])
+	if "mag" in fields:
+		res.mag = np.cos(res.icoord[1])/np.cos(res.ocoord[1])
+	return res
+
+def get_full_rotmat(from_info, to_info):
+	"""Given the expanded systems from_info and to_info as returned by
+	getsys_full, return the rotation matrix R[3,3] that transform_raw
+	applies when transforming between them, or None if that transformation
+	is not a fixed rotation. This is the case for transformations to or from
+	horizontal coordinates, and when the reference point is time-dependent."""
+	(from_sys, from_ref), (to_sys, to_ref) = from_info, to_info
+	if from_sys != to_sys and (from_sys not in rot_systems or to_sys not in rot_systems):
+		return None
+	for ref in [from_ref, to_ref]:
+		if ref is not None and np.asarray(ref).size != len(ref):
+			return None
+	R = np.eye(3)
+	if from_ref is not None: R = euler_mat(decenter_euler(np.asarray(from_ref).reshape(-1))).dot(R)
+	if from_sys != to_sys:   R = get_rotmat(from_sys, to_sys).dot(R)
+	if to_ref   is not None: R = euler_mat(recenter_euler(np.asarray(to_ref).reshape(-1))).dot(R)
+	return R
+
+def transform_raw(from_sys, to_sys, coords, time=None, site=None, out=None, bsize=0x10000):
 	"""Transforms coords[2,...] from system from_sys to system to_sys, where
 	systems can be "hor", "cel" or "gal". For transformations involving
 	"hor", the optional arguments time (in modified julian days) and site (which must
@@ -135,40 +210,74 @@ def transform_raw(from_sys, to_sys, coords, time=None, site=None):
 	with the same shape as the input. The coordinates are in ra,dec-ordering.
 
 	coords and time will be broadcast such that the result has the same shape
-	as coords*time[None]."""
+	as coords*time[None]. The transformation is done in double precision,
+	but the result has the same precision as coords.
+
+	As for transform, the work is done in blocks of bsize samples, and the
+	result is written to out if specified, which may overlap with coords."""
 	# Prepare input and output arrays
-	if time is None:
-		coords = np.array(coords)[:2]
-	else:
+	coords = np.asarray(coords)[:2]
+	dtype  = utils.float_type(coords.dtype)
+	if time is not None:
 		time   = np.asarray(time)
-		coords = np.asarray(coords)
-		# Broadasting. A bit complicated because we want to handle
-		# both time needing to broadcast and coords needing to
-		time   = time + np.zeros(coords[0].shape,time.dtype)
-		coords = (coords.T + np.zeros(time.shape,coords.dtype)[None].T).T
+		if time.ndim > 0:
+			# Broadasting. A bit complicated because we want to handle
+			# both time needing to broadcast and coords needing to
+			time   = time + np.zeros(coords[0].shape,time.dtype)
+			coords = (coords.T + np.zeros(time.shape,coords.dtype)[None].T).T
+			time   = time.reshape(-1)
+	if out is None: out = np.empty(coords.shape, dtype)
+	if out.shape != coords.shape: raise ValueError("out must have shape %s" % str(coords.shape))
 	# flatten, so the rest of the code can assume that coordinates are [2,N]
-	# and time is [N]
-	oshape = coords.shape
-	coords= np.ascontiguousarray(coords.reshape(2,-1))
-	if time is not None: time = time.reshape(-1)
-	# Perform the actual coordinate transformation. There are three classes of
-	# transformations here:
-	# 1. To/from object-centered coordinates
-	# 2. cel-hor transformation, using slalib
-	# 3. cel-gal transformation, using astropy
-	(from_sys,from_ref), (to_sys,to_ref) = getsys_full(from_sys,time,site), getsys_full(to_sys,time,site)
-	if from_ref is not None: coords[:] = decenter(coords, from_ref)
-	if from_sys != to_sys:
-		if from_sys == c.AltAz:
-			coords[:] = hor2cel(coords, time, site, copy=False)
-		coords[:] = transform_astropy(nohor(from_sys), nohor(to_sys), coords)
-		if to_sys == c.AltAz:
-			coords[:] = cel2hor(coords, time, site, copy=False)
-	if to_ref is not None: coords[:] = recenter(coords, to_ref)
-	return coords.reshape(oshape)
+	# and time is [N] or a scalar
+	cflat = coords.reshape(2,-1)
+	info  = getsys_full(from_sys,time,site), getsys_full(to_sys,time,site)
+	with utils.flatview(np.asarray(out), [0], "rw", pos=1) as oflat:
+		for i1 in range(0, cflat.shape[1], bsize):
+			sel  = slice(i1, i1+bsize)
+			work = np.array(cflat[:,sel], dtype=np.float64)
+			if time is None:     btime = None
+			elif time.ndim == 0: btime = np.full(work.shape[1], time)
+			else:                btime = time[sel]
+			# Perform the actual coordinate transformation. There are three classes of
+			# transformations here:
+			# 1. To/from object-centered coordinates
+			# 2. cel-hor transformation, using slalib
+			# 3. cel-gal transformation, using astropy
+			(from_sys,from_ref), (to_sys,to_ref) = select_info(info[0], sel), select_info(info[1], sel)
+			if from_ref is not None: work[:] = decenter(work, from_ref)
+			if from_sys != to_sys:
+				if from_sys == "altaz":
+					work[:] = hor2cel(work, btime, site, copy=False)
+				work[:] = transform_astropy(nohor(from_sys), nohor(to_sys), work)
+				if to_sys == "altaz":
+					work[:] = cel2hor(work, btime, site, copy=False)
+			if to_ref is not None: work[:] = recenter(work, to_ref)
+			oflat[:,sel] = work
+	return out
+
+def select_info(info, sel):
+	"""Restrict an expanded system [sys,ref] as returned by getsys_full to
+	the samples selected by the slice sel. Only per-sample (time-dependent)
+	reference points are affected."""
+	sys, ref = info
+	if ref is None or np.asarray(ref).size == len(ref): return info
+	ref = np.asarray(ref)
+	return [sys, ref.reshape(len(ref),-1)[:,sel]]
 
 def transform_astropy(from_sys, to_sys, coords):
-	"""As transform, but only handles the systems supported by astropy."""
+	"""As transform, but only handles the systems supported by astropy.
+	Transformations between the fixed systems in rot_systems are pure
+	rotations, and are done using a cached rotation matrix instead of
+	constructing a SkyCoord for every call."""
+	from_sys, to_sys = getsys(from_sys), getsys(to_sys)
+	if from_sys == to_sys: return coords
+	if from_sys in rot_systems and to_sys in rot_systems:
+		return transform_rotmat(get_rotmat(from_sys, to_sys), coords)
+	return transform_skycoord(from_sys, to_sys, coords)
+
+def transform_skycoord(from_sys, to_sys, coords):
+	"""As transform_astropy, but always goes through astropy's SkyCoord."""
 	from_sys, to_sys = getsys(from_sys), getsys(to_sys)
 	if from_sys == to_sys: return coords
 	unit   = u.radian
@@ -179,6 +288,31 @@ def transform_astropy(from_sys, to_sys, coords):
 		getattr(getattr(coords, names[0]),unit.name),
 		getattr(getattr(coords, names[1]),unit.name)])
 
+def get_rotmat(from_sys, to_sys):
+	"""Return the rotation matrix R[3,3] that takes unit vectors in from_sys
+	to unit vectors in to_sys, for two of the systems in rot_systems. The
+	matrix is extracted from astropy by transforming the basis vectors,
+	and is cached, so this is only expensive the first time."""
+	key = (getsys(from_sys), getsys(to_sys))
+	if key not in rotmats:
+		basis = rect2ang(np.eye(3), zenith=False)
+		rotmats[key] = ang2rect(transform_skycoord(key[0], key[1], basis), zenith=False)
+	return rotmats[key]
+
+def transform_rotmat(R, coords, bsize=0x10000):
+	"""Rotate the coordinates coords[{lon,lat},...] by the rotation matrix
+	R[3,3]. This is done in blocks of bsize coordinates to avoid large
+	temporaries. The output longitude is in the range [0,2pi), as for
+	astropy."""
+	coords = np.asarray(coords)
+	cflat  = coords.reshape(2,-1)
+	res    = np.empty(cflat.shape)
+	for i in range(0, cflat.shape[1], bsize):
+		rect = ang2rect(cflat[:,i:i+bsize], zenith=False)
+		res[:,i:i+bsize] = rect2ang(R.dot(rect), zenith=False)
+	res[0] %= 2*np.pi
+	return res.reshape(coords.shape)
+
 def hor2cel(coord, time, site, copy=True):
 	coord  = np.array(coord, copy=copy)
 	trepr  = time[len(time)/2]
@@ -236,14 +370,20 @@ def recenter(angs, center):
 	#
 	# Now supports specifying where to recenter by specifying center as
 	# lon_from,lat_from,lon_to,lat_to
-	if len(center) == 4: ra0, dec0, ra1, dec1 = center
-	elif len(center) == 2: ra0, dec0, ra1, dec1 = center[0], center[1], 0, np.pi/2
-	return euler_rot([ra1,dec0-dec1,-ra0], angs, kind="zyz")
+	return euler_rot(recenter_euler(center), angs, kind="zyz")
 def decenter(angs, center):
 	"""Inverse operation of recenter."""
+	return euler_rot(decenter_euler(center), angs, kind="zyz")
+def recenter_euler(center):
+	"""The zyz euler angles of the rotation performed by recenter."""
 	if len(center) == 4: ra0, dec0, ra1, dec1 = center
 	elif len(center) == 2: ra0, dec0, ra1, dec1 = center[0], center[1], 0, np.pi/2
-	return euler_rot([ra0,dec1-dec0,-ra1],  angs, kind="zyz")
+	return [ra1,dec0-dec1,-ra0]
+def decenter_euler(center):
+	"""The zyz euler angles of the rotation performed by decenter."""
+	if len(center) == 4: ra0, dec0, ra1, dec1 = center
+	elif len(center) == 2: ra0, dec0, ra1, dec1 = center[0], center[1], 0, np.pi/2
+	return [ra0,dec1-dec0,-ra1]
 
 def nohor(sys): return sys if sys != "altaz" else "icrs"
 def getsys(sys): return str2sys[sys.lower()] if isinstance(sys,basestring) else sys
@@ -291,10 +431,32 @@ def getsys_full(sys, time=None, site=None):
 		ref = np.array(ref_expanded)
 	return [base, ref]
 
-def ephem_pos(name, mjd):
+def ephem_pos(name, mjd, exact=None):
 	"""Given the name of an ephemeris object from pyephem and a
 	time in modified julian date, return its position in ra, dec
-	in radians in equatorial coordinates."""
+	in radians in equatorial coordinates.
+
+	For large numbers of samples the positions are evaluated from
+	piecewise Chebyshev fits (see ephem_fit), which are cached in memory
+	and on disk, and are accurate to about ephem_tol radians. Set exact
+	to True to always call pyephem directly, or to False to always use the
+	fits. By default the fits are used for more than ephem_nexact samples."""
+	mjd = np.asarray(mjd, dtype=np.float64)
+	if exact is None: exact = mjd.size <= ephem_nexact
+	if exact: return ephem_pos_exact(name, mjd)
+	flat  = mjd.reshape(-1)
+	res   = np.empty((3,flat.size))
+	block = np.floor(flat/ephem_block).astype(int)
+	for b in np.unique(block):
+		mask = block == b
+		edges, coeffs = ephem_fit(name, b)
+		res[:,mask] = eval_chebsegs(edges, coeffs, flat[mask])
+	res = rect2ang(res, zenith=False)
+	res[0] %= 2*np.pi
+	return res.reshape((2,)+mjd.shape)
+
+def ephem_pos_exact(name, mjd):
+	"""As ephem_pos, but calls pyephem for every sample."""
 	mjd = np.asarray(mjd)
 	djd = mjd + 2400000.5 - 2415020
 	obj = getattr(ephem, name)()
@@ -309,6 +471,88 @@ def ephem_pos(name, mjd):
 			res[1,i] = float(obj.a_dec)
 		return res.reshape((2,)+djd.shape)
 
+# Parameters for the ephemeris fits. Each object is fit in blocks of
+# ephem_block days, which are split into segments until a Chebyshev
+# polynomial of degree ephem_deg reproduces pyephem to ephem_tol radians.
+ephem_block  = 32
+ephem_deg    = 12
+ephem_tol    = 1e-9
+ephem_nexact = 100
+ephem_fits   = {}
+
+def ephem_fit(name, block):
+	"""Return the piecewise Chebyshev fit (edges[nseg+1], coeffs[nseg,3,deg+1])
+	to the unit vector of ephemeris object name in the ephem_block days
+	long block of time starting at mjd block*ephem_block. Fits are cached
+	in memory and, if possible, on disk."""
+	key = (name, block)
+	if key in ephem_fits: return ephem_fits[key]
+	cdir  = utils.cache_dir("ephem")
+	fname = None
+	if cdir is not None:
+		fname = os.path.join(cdir, "%s_%s_%d_%d_%g_%d.npz" % (name, ephem.__version__,
+			ephem_block, ephem_deg, ephem_tol, block))
+		try:
+			with np.load(fname) as data:
+				ephem_fits[key] = (data["edges"], data["coeffs"])
+				return ephem_fits[key]
+		except (IOError, OSError, KeyError, ValueError): pass
+	# Adaptively split [t1,t2] until each segment is accurate enough
+	todo  = [(block*ephem_block, (block+1)*ephem_block)]
+	segs  = []
+	while len(todo) > 0:
+		t1, t2 = todo.pop()
+		coeff  = fit_chebseg(name, t1, t2)
+		# Check the fit halfway between the interpolation nodes
+		x      = np.cos(np.pi*np.arange(ephem_deg+1)/(ephem_deg+1))
+		t      = 0.5*(t1+t2) + 0.5*(t2-t1)*x
+		model  = np.polynomial.chebyshev.chebval(x, coeff)
+		exact  = ang2rect(ephem_pos_exact(name, t), zenith=False)
+		if np.max(np.abs(model-exact)) < ephem_tol or t2-t1 < 1e-3:
+			segs.append((t1, coeff))
+		else:
+			todo += [(t1, 0.5*(t1+t2)), (0.5*(t1+t2), t2)]
+	segs.sort(key=lambda seg: seg[0])
+	edges  = np.array([seg[0] for seg in segs] + [(block+1)*ephem_block], dtype=np.float64)
+	coeffs = np.array([seg[1].T for seg in segs])
+	ephem_fits[key] = (edges, coeffs)
+	if fname is not None:
+		# Write to a temporary file first, so that concurrent processes
+		# never see a partially written cache file
+		tmpname = "%s.%d.tmp.npz" % (fname[:-4], os.getpid())
+		try:
+			np.savez(tmpname, edges=edges, coeffs=coeffs)
+			os.rename(tmpname, fname)
+		except (IOError, OSError): pass
+	return edges, coeffs
+
+def fit_chebseg(name, t1, t2):
+	"""Fit a Chebyshev polynomial of degree ephem_deg to the unit vector
+	of the given ephemeris object in the time range [t1,t2]. Returns
+	coeffs[deg+1,3]."""
+	# Chebyshev nodes of the first kind
+	n = ephem_deg+1
+	x = np.cos(np.pi*(np.arange(n)+0.5)/n)
+	t = 0.5*(t1+t2) + 0.5*(t2-t1)*x
+	v = ang2rect(ephem_pos_exact(name, t), zenith=False)
+	return np.polynomial.chebyshev.chebfit(x, v.T, ephem_deg)
+
+def eval_chebsegs(edges, coeffs, t):
+	"""Evaluate the piecewise Chebyshev polynomials edges[nseg+1],
+	coeffs[nseg,ncomp,deg+1] at the times t[n] using the Clenshaw
+	recurrence, returning res[ncomp,n]. Returns unit vectors when
+	used with the output of ephem_fit."""
+	seg = np.clip(np.searchsorted(edges, t, side="right")-1, 0, len(coeffs)-1)
+	t1, t2 = edges[seg], edges[seg+1]
+	x  = (2*t-(t1+t2))/(t2-t1)
+	b1 = np.zeros((coeffs.shape[1],len(t)))
+	b2 = np.zeros_like(b1)
+	for k in range(coeffs.shape[2]-1, 0, -1):
+		b1, b2 = 2*x*b1 - b2 + coeffs[seg,:,k].T, b1
+	res = x*b1 - b2 + coeffs[seg,:,0].T
+	res /= np.sum(res**2,0)**0.5
+	return res
+
 def interpol_pos(from_sys, to_sys, name_or_pos, mjd, site=None, dt=10):
 	"""Given the name of an ephemeris object or a [ra,dec]-type position
 	in radians in from_sys, compute its position in the specified coordinate system for
@@ -337,6 +581,9 @@ str2sys = make_mapping({
 	"icrs":     ["equ", "equatorial", "cel", "celestial", "icrs"],
 	"altaz":    ["altaz", "azel", "hor", "horizontal"],
 	"barycentrictrueecliptic": ["ecl","ecliptic","barycentrictrueecliptic"]})
+# Transformations between these systems are fixed rotations
+rot_systems = ["icrs","galactic","barycentrictrueecliptic"]
+rotmats = {}
 coord_names = {
 	"galactic": ["l","b"],
 	"icrs": ["ra","dec"],
@@ -1,7 +1,8 @@
 """This module provides functions for taking into account the curvature of the
 full sky."""
-import numpy as np, sharp
+import numpy as np
 from . import enmap, powspec, wcsutils, utils
+sharp = utils.lazy_module("sharp")
 
 def rand_map(shape, wcs, ps, lmax=None, dtype=np.float64, seed=None, oversample=2.0, spin=2, method="auto"):
 	"""Generates a CMB realization with the given power spectrum for an enmap
@@ -22,21 +23,76 @@ def rand_map(shape, wcs, ps, lmax=None, dtype=np.float64, seed=None, oversample=
 	if len(shape) == 2: map = map[0]
 	return map
 
+def rand_maps(shape, wcs, ps, seeds, lmax=None, dtype=np.float64, oversample=2.0, spin=2, method="auto", nbatch=4):
+	"""Generate one CMB realization per entry in seeds, yielding them one
+	at a time. Each yielded map is identical to what rand_map(..., seed=seed)
+	would have produced, but the alm_info and the square root of the spectrum
+	are only computed once, and the alms of up to nbatch seeds are synthesized
+	together as a single multi-transform SHT. Only one batch of alms and maps
+	is kept in memory at a time. The yielded maps are views into a buffer
+	that is reused for the next batch, so copy them if they need to outlive
+	the iteration step. The SHT plan is also built only once and shared
+	by all the batches. See write_rand_maps for streaming them to disk."""
+	ps = utils.atleast_3d(ps)
+	assert ps.shape[0] == ps.shape[1], "ps must be [ncomp,ncomp,nl] or [nl]"
+	assert len(shape) == 2 or len(shape) == 3, "shape must be (ncomp,ny,nx) or (ny,nx)"
+	ncomp = 1 if len(shape) == 2 else shape[-3]
+	ps    = ps[:ncomp,:ncomp]
+	seeds = list(seeds)
+	if len(seeds) == 0: return
+	nbatch= max(1,min(nbatch,len(seeds)))
+	ctype = np.result_type(dtype,0j)
+	ainfo = get_ainfo(ps, lmax)
+	ps12  = enmap.multi_pow(ps, 0.5)
+	alm   = np.empty([nbatch,ncomp,ainfo.nelem],dtype=ctype)
+	maps  = enmap.empty((nbatch,ncomp)+tuple(shape[-2:]), wcs, dtype=dtype)
+	sht   = None
+	if method in ["cyl","auto"]:
+		try: sht = make_sht_cyl(maps[0,0], ainfo)
+		except AssertionError:
+			if method == "cyl": raise
+			method = "pos"
+	for i1 in range(0, len(seeds), nbatch):
+		bseeds = seeds[i1:i1+nbatch]
+		nb     = len(bseeds)
+		for i, seed in enumerate(bseeds):
+			fill_rand_alm(alm[i], ps12, ainfo, seed=seed)
+		alm2map(alm[:nb], maps[:nb], ainfo=ainfo, spin=spin, oversample=oversample, method=method, sht=sht)
+		for i in range(nb):
+			yield maps[i,0] if len(shape) == 2 else maps[i]
+
+def write_rand_maps(fname, shape, wcs, ps, seeds, lmax=None, dtype=np.float64, oversample=2.0, spin=2, method="auto", nbatch=4):
+	"""Generate realizations using rand_maps, and write each of them to disk
+	as soon as it is ready. fname is a format string that will be formatted
+	with the seed used, e.g. "sim_%04d.fits"."""
+	seeds = list(seeds)
+	for seed, map in zip(seeds, rand_maps(shape, wcs, ps, seeds, lmax=lmax, dtype=dtype,
+			oversample=oversample, spin=spin, method=method, nbatch=nbatch)):
+		enmap.write_map(fname % seed, map)
+
 def rand_alm_healpy(ps, lmax=None, seed=None, dtype=np.complex128):
 	import healpy
 	if seed is not None: np.random.seed(seed)
 	ps = powspec.sym_compress(ps, scheme="diag")
 	return np.asarray(healpy.synalm(ps, lmax=lmax, new=True))
 
-def rand_alm(ps, ainfo=None, lmax=None, seed=None, dtype=np.complex128, m_major=True):
+def get_ainfo(ps, lmax=None):
+	"""Construct the alm_info used by rand_alm for the spectrum ps
+	when no explicit alm_info is passed."""
+	nl = np.shape(ps)[-1]
+	return sharp.alm_info(min(lmax,nl-1) or nl-1)
+
+def rand_alm(ps, ainfo=None, lmax=None, seed=None, dtype=np.complex128, m_major=True, nthread=None):
 	"""This is a replacement for healpy.synalm. It generates the random
 	numbers in l-major order before transposing to m-major order in order
 	to allow generation of low-res and high-res maps that agree on large
 	scales. It uses 2/3 of the memory of healpy.synalm, and has comparable
-	speed."""
-	rtype = np.zeros([0],dtype=dtype).real.dtype
+	speed. The random numbers are drawn in parallel using nthread threads,
+	with the result depending only on the seed, which can be an integer or
+	a list of integers. If no seed is passed, one is drawn from numpy's
+	global random state."""
 	ps    = np.asarray(ps)
-	if ainfo is None: ainfo = sharp.alm_info(min(lmax,ps.shape[-1]-1) or ps.shape[-1]-1)
+	if ainfo is None: ainfo = get_ainfo(ps, lmax)
 	if ps.ndim == 1:
 		wps = ps[None,None]
 	elif ps.ndim == 2:
@@ -47,43 +103,61 @@ def rand_alm(ps, ainfo=None, lmax=None, seed=None, dtype=np.complex128, m_major=
 		raise ValuerError("power spectrum must be [nl], [nspec,nl] or [ncomp,ncomp,nl]")
 	ncomp = wps.shape[0]
 	ps12  = enmap.multi_pow(wps, 0.5)
-	# Draw random gaussian numbers in chunks to save memory
 	alm   = np.empty([ncomp,ainfo.nelem],dtype=dtype)
-	aflat = alm.reshape(-1).view(rtype)
+	fill_rand_alm(alm, ps12, ainfo, seed=seed, m_major=m_major, nthread=nthread)
+	if ps.ndim == 1: alm = alm[0]
+	return alm
+
+def fill_rand_alm(alm, ps12, ainfo, seed=None, m_major=True, nthread=None):
+	"""Fill alm[ncomp,nelem] with a random realization of the spectrum
+	whose matrix square root is ps12[ncomp,ncomp,nl]. This is the work
+	horse of rand_alm, split out so that the square root can be reused
+	when drawing many realizations."""
+	rtype = np.zeros([0],dtype=alm.dtype).real.dtype
+	# Draw random gaussian numbers in chunks to save memory. Each chunk
+	# has its own random stream, seeded by [seed,comp,chunk], so that the
+	# result only depends on the seed, and not on the number of threads.
+	# Since the chunks are laid out in l-major order independently for
+	# each component, chunk i always covers the same (l,m) regardless of
+	# lmax, which is what makes low- and high-res realizations agree.
+	aflat = alm.view(rtype)
 	bsize = 0x10000
-	if seed != None: np.random.seed(seed)
-	for i in range(0, aflat.size, bsize):
-		aflat[i:i+bsize] = np.random.standard_normal(min(bsize,aflat.size-i))
+	if seed is None: seed = np.random.randint(0x7fffffff)
+	seed  = [int(s) for s in np.atleast_1d(seed)]
+	def fill(job):
+		ci, i = job
+		rng = np.random.RandomState(seed + [ci, i//bsize])
+		aflat[ci,i:i+bsize] = rng.standard_normal(min(bsize,aflat.shape[1]-i))
+	utils.threaded_map(fill, [(ci,i) for ci in range(aflat.shape[0]) for i in range(0, aflat.shape[1], bsize)], nthread=nthread)
 	# Transpose numbers to make them m-major.
 	if m_major: ainfo.transpose_alm(alm,alm)
 	# Scale alms by spectrum, taking into account which alms are complex
 	ainfo.lmul(alm, (ps12/2**0.5).astype(rtype), alm)
 	alm[:,:ainfo.lmax].imag  = 0
 	alm[:,:ainfo.lmax].real *= 2**0.5
-	if ps.ndim == 1: alm = alm[0]
 	return alm
 
-def alm2map(alm, map, ainfo=None, spin=2, deriv=False, direct=False, copy=False, oversample=2.0, method="auto"):
+def alm2map(alm, map, ainfo=None, spin=2, deriv=False, direct=False, copy=False, oversample=2.0, method="auto", sht=None):
 	if method == "cyl":
-		alm2map_cyl(alm, map, ainfo=ainfo, spin=spin, deriv=deriv, direct=direct, copy=copy)
+		alm2map_cyl(alm, map, ainfo=ainfo, spin=spin, deriv=deriv, direct=direct, copy=copy, sht=sht)
 	elif method == "pos":
-		pos = map.posmap()
+		pos = map.posmap(dtype=utils.float_type(map.dtype))
 		res = alm2map_pos(alm, pos, ainfo=ainfo, oversample=oversample, spin=spin, deriv=deriv)
 		map[:] = res
 	elif method == "auto":
 		# Cylindrical method if possible, else slow pos-based method
 		try:
-			alm2map_cyl(alm, map, ainfo=ainfo, spin=spin, deriv=deriv, direct=direct, copy=copy)
+			alm2map_cyl(alm, map, ainfo=ainfo, spin=spin, deriv=deriv, direct=direct, copy=copy, sht=sht)
 		except AssertionError as e:
 			# Wrong pixelization. Fall back on slow, general method
-			pos = map.posmap()
+			pos = map.posmap(dtype=utils.float_type(map.dtype))
 			res = alm2map_pos(alm, pos, ainfo=ainfo, oversample=oversample, spin=spin, deriv=deriv)
 			map[:] = res
 	else:
 		raise ValueError("Unknown alm2map method %s" % method)
 	return map
 
-def alm2map_cyl(alm, map, ainfo=None, spin=2, deriv=False, direct=False, copy=False):
+def alm2map_cyl(alm, map, ainfo=None, spin=2, deriv=False, direct=False, copy=False, sht=None):
 	"""When called as alm2map(alm, map) projects those alms onto that map.
 	alms are interpreted according to ainfo if specified.
 
@@ -100,6 +174,9 @@ def alm2map_cyl(alm, map, ainfo=None, spin=2, deriv=False, direct=False, copy=Fa
 	sky horizontally, so that no intermediate maps need to be computed.
 
 	If copy=True, the input map is not overwritten.
+
+	sht is an optional precomputed sharp.sht plan from make_sht_cyl, which
+	saves rebuilding it when transforming many maps with the same geometry.
 	"""
 	# Work on views of alm and map with shape alm_full[ntrans,ncomp,nalm]
 	# and map[ntrans,ncomp/nderiv,ny,nx] to avoid lots of if tests later.
@@ -112,7 +189,7 @@ def alm2map_cyl(alm, map, ainfo=None, spin=2, deriv=False, direct=False, copy=Fa
 		tmap, mslices, tslices = map_full, [(Ellipsis,)], [(Ellipsis,)]
 	else:
 		tmap, mslices, tslices = make_projectable_map_cyl(map_full)
-	sht    = sharp.sht(map2minfo(tmap), ainfo)
+	if sht is None: sht = sharp.sht(map2minfo(tmap), ainfo)
 	# We need a pixel-flattened version for the SHTs.
 	tflat  = tmap.reshape(tmap.shape[:-2]+(-1,))
 
@@ -154,11 +231,21 @@ def alm2map_pos(alm, pos=None, ainfo=None, oversample=2.0, spin=2, deriv=False):
 	alm2map_cyl(alm, tmap, ainfo=ainfo, spin=spin, deriv=deriv, direct=True)
 	# Project down on our final pixels. This will result in a slight smoothing
 	pix = tmap.sky2pix(pos[:2])
-	res = enmap.samewcs(utils.interpol(tmap, pix, mode="wrap"), pos)
+	res = enmap.samewcs(utils.interpol(tmap, pix, mode="nearest", wrap=True), pos)
 	# Remove any extra dimensions we added
 	if alm.ndim == alm_full.ndim-1: res = res[0]
 	return res
 
+def make_sht_cyl(map, ainfo, direct=False):
+	"""Build the sharp.sht plan alm2map_cyl would use for map with the
+	given alm_info, so that it can be reused for several transforms onto
+	maps with the same geometry. Raises an AssertionError if map does not
+	have a cylindrical pixelization."""
+	# Only the pixelization matters, so drop any pre-dimensions
+	map = map[(0,)*(map.ndim-2)]
+	if not direct: map = make_projectable_map_cyl(map)[0]
+	return sharp.sht(map2minfo(map), ainfo)
+
 def make_projectable_map_cyl(map):
 	"""Given an enmap in a cylindrical projection, return a map with
 	the same pixelization, but extended to cover a whole band in phi
@@ -220,7 +307,7 @@ def make_projectable_map(pos, lmax, dims=(), oversample=2.0, dtype=float):
 	# the south pole to the north pole for full-sky maps
 	wcs.wcs.crpix = [nx/2,-decrange[0]/res+1]
 	wcs.wcs.ctype = ["RA---CAR","DEC--CAR"]
-	tmap = enmap.zeros(dims+(ny+1,nx),wcs)
+	tmap = enmap.zeros(dims+(ny+1,nx),wcs,dtype=dtype)
 	return tmap
 
 def map2minfo(m):
@@ -1,5 +1,6 @@
-import numpy as np, scipy.ndimage, warnings, astropy.io.fits, sys
+import numpy as np, warnings, sys, os
 from . import utils, wcsutils, powspec
+astropy = utils.lazy_module("astropy")
 
 # Things that could be improved:
 #  1. We assume exactly 2 WCS axes in spherical projection in {dec,ra} order.
@@ -21,17 +22,36 @@ from . import utils, wcsutils, powspec
 # itself uses column-major ordering. So an array which is (ncomp,ny,nx)
 # will be (nx,ny,ncomp) in the file. This means that the axes in the ndmap
 # will be in the opposite order of those in the wcs object.
+# Set to True to give each ndmap its own copy of its wcs, as older versions
+# did, for code that modifies map wcses in place. See ndmap.
+copy_wcs = False
+
 class ndmap(np.ndarray):
 	"""Implements (stacks of) flat, rectangular, 2-dimensional maps as a dense
 	numpy array with a fits WCS. The axes have the reverse ordering as in the
 	fits file, and hence the WCS object. This class is usually constructed by
 	using one of the functions following it, much like numpy arrays. We assume
 	that the WCS only has two axes with unit degrees. The ndmap itself uses
-	radians for everything."""
+	radians for everything.
+
+	Attributes
+	----------
+	wcs : astropy.wcs.WCS
+		The world coordinate system of the map. This is not copied, but
+		shared with the map or wcs it came from, and with everything derived
+		from the map that keeps its pixel grid, e.g. ufunc results, samewcs
+		outputs and slices starting at zero with unit step. So it must be
+		treated as immutable: modifying it in place, e.g. with
+		m.wcs.wcs.crpix += 1, silently changes all those maps too. This
+		differs from earlier versions, which gave each map its own copy.
+		Use ndmap.copy() or wcs.deepcopy() to get a wcs that is safe to
+		modify, or set enmap.copy_wcs = True to go back to copying the wcs
+		for every new map. astropy returns a fresh view of the wcslib
+		parameters on each access, so the wcs can't be made read-only."""
 	def __new__(cls, arr, wcs):
 		"""Wraps a numpy and bounding box into an ndmap."""
 		obj = np.asarray(arr).view(cls)
-		obj.wcs = wcs.deepcopy()
+		obj.wcs = wcs.deepcopy() if copy_wcs else wcs
 		return obj
 	def __array_finalize__(self, obj):
 		if obj is None: return
@@ -45,11 +65,11 @@ class ndmap(np.ndarray):
 		if arr.ndim < 2: return arr
 		return ndmap(arr, self.wcs)
 	def copy(self, order='K'):
-		return ndmap(np.copy(self,order), self.wcs)
+		return ndmap(np.copy(self,order), self.wcs.deepcopy())
 	def sky2pix(self, coords, safe=True, corner=False): return sky2pix(self.shape, self.wcs, coords, safe, corner)
 	def pix2sky(self, pix,    safe=True, corner=False): return pix2sky(self.shape, self.wcs, pix,    safe, corner)
 	def box(self): return box(self.shape, self.wcs)
-	def posmap(self, corner=False): return posmap(self.shape, self.wcs, corner=corner)
+	def posmap(self, corner=False, dtype=np.float64): return posmap(self.shape, self.wcs, corner=corner, dtype=dtype)
 	def pixmap(self): return pixmap(self.shape, self.wcs)
 	def lmap(self, oversample=1): return lmap(self.shape, self.wcs, oversample=oversample)
 	def area(self): return area(self.shape, self.wcs)
@@ -61,8 +81,8 @@ class ndmap(np.ndarray):
 		return self.reshape(-1, self.shape[-2], self.shape[-1])
 	@property
 	def npix(self): return np.product(self.shape[-2:])
-	def project(self, shape, wcs, order=3, mode="nearest", mask_nan=True): return project(self, shape, wcs, order, mode=mode, cval=0, mask_nan=mask_nan)
-	def at(self, pos, order=3, mode="constant", cval=0.0, unit="coord", prefilter=True, mask_nan=True): return at(self, pos, order, mode=mode, cval=0, unit=unit, prefilter=prefilter, mask_nan=mask_nan)
+	def project(self, shape, wcs, order=3, mode="nearest", mask_nan=True, pos_dtype=np.float64): return project(self, shape, wcs, order, mode=mode, cval=0, mask_nan=mask_nan, pos_dtype=pos_dtype)
+	def at(self, pos, order=3, mode="constant", cval=0.0, unit="coord", prefilter=True, mask_nan=True, pol_angle=None, comps=[-2,-1], bsize=0x40000): return at(self, pos, order, mode=mode, cval=0, unit=unit, prefilter=prefilter, mask_nan=mask_nan, pol_angle=pol_angle, comps=comps, bsize=bsize)
 	def autocrop(self, method="plain", value="auto", margin=0, factors=None, return_info=False): return autocrop(self, method, value, margin, factors, return_info)
 	def apod(self, width, profile="cos", fill="zero"): return apod(self, width, profile=profile, fill=fill)
 	def stamps(self, pos, shape, aslist=False): return stamps(self, pos, shape, aslist=aslist)
@@ -129,21 +149,19 @@ class ndmap(np.ndarray):
 def slice_wcs(shape, wcs, sel):
 	"""Slice a geometry specified by shape and wcs according to the
 	slice sel. Returns a tuple of the output shape and the correponding
-	wcs."""
-	wcs = wcs.deepcopy()
+	wcs. The wcs is returned as is if the slice does not change the pixel
+	grid, i.e. if it starts at zero with unit step."""
 	pre, shape = shape[:-2], shape[-2:]
-	oshape = np.array(shape)
-	# The wcs object has the indices in reverse order
-	for i,s in enumerate(sel):
-		s = utils.expand_slice(s, shape[i])
-		j = -1-i
-		start = s.start if s.step > 0 else s.start + 1
-		wcs.wcs.crpix[j] -= start+0.5
-		wcs.wcs.crpix[j] /= s.step
-		wcs.wcs.cdelt[j] *= s.step
-		wcs.wcs.crpix[j] += 0.5
-		oshape[i] = s.stop-s.start
-		oshape[i] = (oshape[i]+s.step-1)/s.step
+	sel   = list(sel) + [slice(None)]*(2-len(sel))
+	sel   = [utils.expand_slice(s, shape[i]) for i,s in enumerate(sel)]
+	start = np.array([s.start if s.step > 0 else s.start + 1 for s in sel])
+	step  = np.array([s.step for s in sel])
+	if np.any(start != 0) or np.any(step != 1):
+		# The wcs object has the indices in reverse order
+		wcs = wcs.deepcopy()
+		wcs.wcs.crpix = (wcs.wcs.crpix-start[::-1]-0.5)/step[::-1]+0.5
+		wcs.wcs.cdelt = wcs.wcs.cdelt*step[::-1]
+	oshape = [(s.stop-s.start+s.step-1)/s.step for s in sel]
 	return tuple(pre)+tuple(oshape), wcs
 
 def scale_wcs(wcs, factor):
@@ -178,9 +196,10 @@ def enmap(arr, wcs=None, dtype=None, copy=True):
 		The data type of the map.
 		Default: Same as arr.
 	copy : boolean
-		If true, arr is copied. Otherwise, a referance is kept."""
+		If true, arr and wcs are copied. Otherwise, references are kept."""
 	if copy:
 		arr = np.asanyarray(arr, dtype=dtype).copy()
+		if wcs is not None: wcs = wcs.deepcopy()
 	if wcs is None:
 		if isinstance(arr, ndmap):
 			wcs = arr.wcs
@@ -197,14 +216,69 @@ def ones(shape, wcs=None, dtype=None):
 def full(shape, wcs, val, dtype=None):
 	return enmap(np.full(shape, val, dtype=dtype), wcs, copy=False)
 
-def posmap(shape, wcs, safe=True, corner=False):
+def posmap(shape, wcs, safe=True, corner=False, dtype=np.float64, bsize=0x100, out=None):
 	"""Return an enmap where each entry is the coordinate of that entry,
 	such that posmap(shape,wcs)[{0,1},j,k] is the {y,x}-coordinate of
 	pixel (j,k) in the map. Results are returned in radians, and
 	if safe is true (default), then sharp coordinate edges will be
-	avoided."""
-	pix    = np.mgrid[:shape[-2],:shape[-1]]
-	return ndmap(pix2sky(shape, wcs, pix, safe, corner), wcs)
+	avoided.
+
+	The positions are computed in double precision in blocks of bsize
+	rows, and then stored with the given dtype, so no full-size double
+	precision temporaries are needed when dtype is np.float32. In single
+	precision the positions are accurate to about 2e-7 radians (0.05
+	arcsec), which is negligible for pixels larger than a few arcsec.
+	If out is specified, the positions are written there instead, and
+	dtype is ignored."""
+	res = out if out is not None else np.empty((2,)+tuple(shape[-2:]), dtype=dtype)
+	for y1 in range(0, shape[-2], bsize):
+		y2  = min(y1+bsize, shape[-2])
+		pix = np.mgrid[y1:y2,:shape[-1]]
+		res[:,y1:y2] = pix2sky(shape, wcs, pix, safe, corner)
+	return ndmap(res, wcs)
+
+# Maximum size in bytes of the on-disk cache used by posmap_transformed
+posmap_cache_size = 4<<30
+
+def posmap_transformed(shape, wcs, sys, to_sys, pol=False, dtype=np.float64, cache=True):
+	"""Return the coordinates in to_sys of the pixels of the geometry
+	(shape,wcs), which is assumed to be in the coordinate system sys,
+	as pos[{dec,ra},ny,nx]. If pol is True, the polarization rotation
+	angle of the transformation is returned too, as (pos,ang), otherwise
+	(pos,None). The systems are those understood by coordinates.transform.
+
+	Computing these takes a while for large maps, but only depends on the
+	arguments, so unless cache is False the result is stored in an on-disk
+	cache under utils.cache_dir(), from which the least recently used files
+	are evicted once it grows beyond posmap_cache_size bytes."""
+	from . import coordinates
+	shape, pol, dtype = tuple(shape[-2:]), bool(pol), np.dtype(dtype)
+	cdir = utils.cache_dir("posmap") if cache else None
+	if cdir is not None:
+		key   = utils.cache_key("posmap_transformed", 1, shape, wcs.to_header_string(),
+				str(sys), str(to_sys), pol, dtype.str)
+		fname = os.path.join(cdir, key + ".npy")
+		try:
+			buf = np.load(fname)
+			os.utime(fname, None)
+		except (IOError, OSError, ValueError): buf = None
+		if buf is not None and buf.shape == (2+pol,)+shape and buf.dtype == dtype:
+			buf = ndmap(buf, wcs)
+			return buf[-2:], buf[0] if pol else None
+	# The coordinates are computed in a single [ang,dec,ra] buffer, which
+	# the coordinate transformation updates in place using [ra,dec,ang] order.
+	buf = empty((2+pol,)+shape, wcs, dtype)
+	pos = buf[-2:]
+	posmap(shape, wcs, out=pos)
+	coordinates.transform(sys, to_sys, pos[::-1], pol=pol, out=buf[::-1])
+	if cdir is not None:
+		tmpname = "%s.%d.tmp" % (fname, os.getpid())
+		try:
+			with open(tmpname, "wb") as f: np.save(f, np.asarray(buf))
+			os.rename(tmpname, fname)
+			utils.cache_evict(cdir, posmap_cache_size)
+		except (IOError, OSError): pass
+	return pos, buf[0] if pol else None
 
 def pixmap(shape, wcs=None):
 	"""Return an enmap where each entry is the pixel coordinate of that entry."""
@@ -213,54 +287,137 @@ def pixmap(shape, wcs=None):
 
 def pix2sky(shape, wcs, pix, safe=True, corner=False):
 	"""Given an array of corner-based pixel coordinates [{y,x},...],
-	return sky coordinates in the same ordering."""
-	pix = np.asarray(pix).astype(float)
+	return sky coordinates in the same ordering. Single precision
+	input results in single precision output, but the computation itself
+	is always done in double precision."""
+	pix = np.asarray(pix)
+	dtype = utils.float_type(pix.dtype)
+	pix = pix.astype(float)
 	if corner: pix -= 0.5
 	pflat = pix.reshape(pix.shape[0], -1)
 	coords = np.asarray(wcs.wcs_pix2world(*(tuple(pflat)[::-1]+(0,)))[::-1])*get_unit(wcs)
 	coords = coords.reshape(pix.shape)
 	if safe and not wcsutils.is_plain(wcs):
 		coords = utils.unwind(coords)
-	return coords
+	return coords.astype(dtype, copy=False)
 
-def sky2pix(shape, wcs, coords, safe=True, corner=False):
+def sky2pix(shape, wcs, coords, safe=True, corner=False, method="auto", out=None, bsize=0x100000):
 	"""Given an array of coordinates [{dec,ra},...], return
 	pixel coordinates with the same ordering. The corner argument
 	specifies whether pixel coordinates start at pixel corners
 	or pixel centers. This represents a shift of half a pixel.
 	If corner is False, then the integer pixel closest to a position
-	is round(sky2pix(...)). Otherwise, it is floor(sky2pix(...))."""
-	coords = np.asarray(coords)/get_unit(wcs)
-	cflat  = coords.reshape(coords.shape[0], np.prod(coords.shape[1:]))
+	is round(sky2pix(...)). Otherwise, it is floor(sky2pix(...)).
+	As for pix2sky, the output precision follows that of the input.
+
+	For the plain, CAR and CEA geometries built by wcsutils, the projection
+	is evaluated in closed form instead of going through wcslib, unless
+	method is "wcslib". The coordinates are processed in chunks of bsize,
+	and the result is written to out if specified."""
+	coords = np.asarray(coords)
+	if out is None: out = np.empty(coords.shape, utils.float_type(coords.dtype))
+	native = wcsutils.native_params(wcs) if method != "wcslib" else None
+	if method == "native" and native is None:
+		raise ValueError("sky2pix: wcs %s has no native implementation" % wcsutils.describe(wcs))
+	unit   = get_unit(wcs)
+	cflat  = coords.reshape(coords.shape[0], -1)
 	# Quantities with a w prefix are in wcs ordering (ra,dec)
-	wpix = np.asarray(wcs.wcs_world2pix(*tuple(cflat)[::-1]+(0,)))
 	wshape = shape[-2:][::-1]
-	if corner: wpix += 0.5
-	if safe and not wcsutils.is_plain(wcs):
-		# Put the angle cut as far away from the map as possible.
-		# We do this by putting the reference point in the middle
-		# of the map.
-		wrefpix = np.array(wshape)/2.
-		if corner: wrefpix += 0.5
-		for i in range(len(wpix)):
-			wn = np.abs(360./wcs.wcs.cdelt[i])
-			wpix[i] = utils.rewind(wpix[i], wrefpix[i], wn)
-	return wpix[::-1].reshape(coords.shape)
-
-def project(map, shape, wcs, order=3, mode="nearest", cval=0.0, mask_nan=True):
+	# Put the angle cut as far away from the map as possible.
+	# We do this by putting the reference point in the middle
+	# of the map.
+	wrefpix = np.array(wshape)[:,None]/2.
+	if corner: wrefpix += 0.5
+	wn = np.abs(360./wcs.wcs.cdelt)[:,None]
+	with utils.flatview(out, [0], "rw", pos=1) as oflat:
+		for i1 in range(0, cflat.shape[1], bsize):
+			# Work in place on a double precision copy of this chunk
+			wpix = cflat[::-1,i1:i1+bsize].astype(np.float64)
+			wpix /= unit
+			if native is not None: wcsutils.world2pix_native(native, wpix, out=wpix, wrap=not safe)
+			else: wpix = np.asarray(wcs.wcs_world2pix(*tuple(wpix)+(0,)))
+			if corner: wpix += 0.5
+			if safe and not wcsutils.is_plain(wcs):
+				# Same as utils.rewind(wpix, wrefpix, wn), but in place.
+				# floor is much faster than % here.
+				wpix -= wrefpix-wn/2
+				tmp   = wpix/wn
+				np.floor(tmp, tmp)
+				tmp  *= wn
+				wpix -= tmp
+				wpix += wrefpix-wn/2
+			oflat[:,i1:i1+bsize] = wpix[::-1]
+	return out
+
+def project(map, shape, wcs, order=3, mode="nearest", cval=0.0, mask_nan=True, pos_dtype=np.float64, wrap="auto"):
 	"""Project the map into a new map given by the specified
 	shape and wcs, interpolating as necessary. Handles nan
 	regions in the map by masking them before interpolating.
 	This uses local interpolation, and will lose information
-	when downgrading compared to averaging down."""
+	when downgrading compared to averaging down. The pixel positions
+	are computed with the precision given by pos_dtype, which defaults
+	to double precision. Pass np.float32 to save memory for single
+	precision maps. If wrap is True, the map is interpolated periodically
+	in RA. By default this is done if the map covers all RA (see wraps_ra)."""
+	if wrap == "auto": wrap = wraps_ra(map.shape, map.wcs)
 	map  = map.copy()
-	pix  = map.sky2pix(posmap(shape, wcs))
-	pmap = utils.interpol(map, pix, order=order, mode=mode, cval=cval, mask_nan=mask_nan)
+	pix  = posmap(shape, wcs, dtype=pos_dtype)
+	sky2pix(map.shape, map.wcs, pix, out=pix)
+	pmap = utils.interpol(map, pix, order=order, mode=mode, cval=cval, mask_nan=mask_nan, wrap=wrap)
 	return ndmap(pmap, wcs)
 
-def at(map, pos, order=3, mode="constant", cval=0.0, unit="coord", prefilter=True, mask_nan=True):
-	if unit != "pix": pos = sky2pix(map.shape, map.wcs, pos)
-	return utils.interpol(map, pos, order=order, mode=mode, cval=cval, prefilter=prefilter, mask_nan=mask_nan)
+def at(map, pos, order=3, mode="constant", cval=0.0, unit="coord", prefilter=True, mask_nan=True, pol_angle=None, comps=[-2,-1], bsize=0x40000, wrap="auto"):
+	"""Interpolate map at the positions pos[{dec,ra},...], or at the pixel
+	positions pos[{y,x},...] if unit is "pix". If pol_angle[...] is specified,
+	the components comps of the result are rotated by that angle as in
+	rotate_pol. In that case the interpolation is done in blocks of about
+	bsize positions, with each block rotated as soon as it is produced, so
+	no full-size intermediate maps are needed. If wrap is True, the map is
+	interpolated periodically in RA. By default this is done if the map
+	covers all RA (see wraps_ra)."""
+	if wrap == "auto": wrap = wraps_ra(map.shape, map.wcs)
+	if pol_angle is None:
+		if unit != "pix": pos = sky2pix(map.shape, map.wcs, pos)
+		return utils.interpol(map, pos, order=order, mode=mode, cval=cval, prefilter=prefilter, mask_nan=mask_nan, wrap=wrap)
+	# Flatten the position array to [2,nrow,ncol]
+	pos    = np.asarray(pos)
+	pshape = pos.shape[1:]
+	pos    = pos.reshape(2, (pshape+(1,))[0], -1)
+	angle  = np.asarray(pol_angle)
+	if angle.ndim > 0: angle = np.broadcast_to(angle, pshape).reshape(pos.shape[1:])
+	# Do the parts of utils.interpol that involve the whole map up front:
+	# masking nans and the spline prefiltering
+	work = np.asarray(map)
+	mask = None
+	if mask_nan:
+		mask = ~np.isfinite(work)
+		if np.any(mask): work = np.where(mask, 0, work)
+		else: mask = None
+	# The coefficients may be padded, in which case the positions must be
+	# offset by the padding in all but the periodic direction
+	off  = np.zeros([2,1,1])
+	if prefilter and order > 1:
+		work, npad = utils.interpol_prefilter(work, npre=map.ndim-2, order=order, inplace=mask is not None, wrap=wrap, mode=mode, pad=True)
+		off[:2-wrap] = npad
+	res   = np.empty(map.shape[:-2]+pos.shape[1:], map.dtype)
+	nrow  = max(1, bsize//pos.shape[2])
+	for y1 in range(0, pos.shape[1], nrow):
+		y2  = min(y1+nrow, pos.shape[1])
+		pix = pos[:,y1:y2]
+		if unit != "pix": pix = sky2pix(map.shape, map.wcs, pix)
+		block = utils.interpol(work, pix+off, order=order, mode=mode, cval=cval, prefilter=False, mask_nan=False, wrap=wrap)
+		if mask is not None:
+			bmask = utils.interpol(mask, pix, order=0, mode=mode, cval=cval, prefilter=False, mask_nan=False, wrap=wrap)
+			block[bmask] = np.nan
+		res[...,y1:y2,:] = rotate_pol(block, angle[y1:y2] if angle.ndim > 0 else angle, comps, out=block)
+	return res.reshape(map.shape[:-2]+pshape)
+
+def wraps_ra(shape, wcs):
+	"""Returns True if the geometry covers exactly 360 degrees in RA,
+	so that its last pixel axis is periodic."""
+	if wcsutils.is_plain(wcs): return False
+	nper = 360./np.abs(wcs.wcs.cdelt[0])
+	return abs(nper - shape[-1]) < 1e-6*nper
 
 def argmax(map, unit="coord"):
 	"""Return the coordinates of the maximum value in the specified map.
@@ -303,7 +460,8 @@ def rand_gauss_harm(shape, wcs):
 def rand_gauss_iso_harm(shape, wcs, cov):
 	"""Generates an isotropic random map with component covariance
 	cov in harmonic space, where cov is a (comp,comp,l) array."""
-	data = map_mul(spec2flat(shape, wcs, cov, 0.5, mode="constant"), rand_gauss_harm(shape, wcs))
+	data = rand_gauss_harm(shape, wcs)
+	map_mul(spec2flat(shape, wcs, cov, 0.5, mode="constant", copy=False), data, out=data)
 	return ndmap(data, wcs)
 
 def extent(shape, wcs, method="intermediate", nsub=None):
@@ -422,17 +580,17 @@ def ifft(emap, normalize=True):
 # use real transforms.
 def map2harm(emap, nthread=0):
 	"""Performs the 2d FFT of the enmap pixels, returning a complex enmap."""
-	emap = samewcs(fft(emap,nthread=nthread), emap)
+	emap = samewcs(fft(emap), emap)
 	if emap.ndim > 2 and emap.shape[-3] > 1:
 		rot = queb_rotmat(emap.lmap())
-		emap[...,-2:,:,:] = map_mul(rot, emap[...,-2:,:,:])
+		map_mul(rot, emap[...,-2:,:,:], out=emap[...,-2:,:,:])
 	return emap
 def harm2map(emap, nthread=0, normalize=True):
 	if emap.ndim > 2 and emap.shape[-3] > 1:
 		rot = queb_rotmat(emap.lmap(), inverse=True)
 		emap = emap.copy()
-		emap[...,-2:,:,:] = map_mul(rot, emap[...,-2:,:,:])
-	return samewcs(ifft(emap,nthread=nthread), emap).real
+		map_mul(rot, emap[...,-2:,:,:], out=emap[...,-2:,:,:])
+	return samewcs(ifft(emap), emap).real
 
 def queb_rotmat(lmap, inverse=False):
 	a    = 2*np.arctan2(lmap[0], lmap[1])
@@ -440,28 +598,69 @@ def queb_rotmat(lmap, inverse=False):
 	if inverse: s = -s
 	return samewcs(np.array([[c,-s],[s,c]]),lmap)
 
-def rotate_pol(emap, angle, comps=[-2,-1]):
-	c, s = np.cos(2*angle), np.sin(2*angle)
-	res = emap.copy()
-	res[...,comps[0],:,:] = c*emap[...,comps[0],:,:] - s*emap[...,comps[1],:,:]
-	res[...,comps[1],:,:] = s*emap[...,comps[0],:,:] + c*emap[...,comps[1],:,:]
-	return res
-
-def map_mul(mat, vec):
-	"""Elementwise matrix multiplication mat*vec. Result will have
-	the same shape as vec. Multiplication happens along the first indices.
-	This function is buggy when mat is not square (in the multiplication
-	dimensions). This is due to the reshape at the end. I should figure out
-	what code depends on that, and decide what I really want this function
-	to do."""
-	oshape= vec.shape
-	if len(oshape) == 2: oshape = (1,)+oshape
-	tvec = np.reshape(vec, oshape)
-	# It is a bit clunky to get einsum to handle arbitrary numbers of dimensions.
-	vpre  = "".join([chr(ord('a')+i) for i in range(len(oshape)-3)])
-	mpre  = vpre[vec.ndim-(mat.ndim-1):]
-	data  = np.reshape(np.einsum("%sxyzw,%syzw->%sxzw" % (mpre,vpre,vpre), mat, tvec), vec.shape)
-	return samewcs(data, mat, vec)
+def sanitize(map, vals=[], fill=0, scale=1, rtol=1e-5, atol=1e-8, inplace=True):
+	"""Replace non-finite pixels and pixels matching the sentinel values
+	vals (e.g. healpy.UNSEEN) by fill, and multiply the rest by scale.
+	This is done in place in a single, blocked pass. See utils.sanitize."""
+	return samewcs(utils.sanitize(map, vals, fill=fill, scale=scale, rtol=rtol, atol=atol, inplace=inplace), map)
+
+def rotate_pol(emap, angle, comps=[-2,-1], out=None, bsize=0x40):
+	"""Rotate the polarization components comps of emap[...,ncomp,ny,nx]
+	by the angle[ny,nx] (or a scalar), returning a new map. The work is
+	done in blocks of bsize rows to avoid full-size temporaries. Pass
+	out=emap to rotate in place."""
+	if out is None: out = emap.copy()
+	elif out is not emap: out[...] = emap
+	angle = np.asarray(angle)
+	for y1 in range(0, emap.shape[-2], bsize):
+		y2 = min(y1+bsize, emap.shape[-2])
+		a  = angle[...,y1:y2,:] if angle.ndim > 1 and angle.shape[-2] > 1 else angle
+		c, s = np.cos(2*a), np.sin(2*a)
+		q, u = out[...,comps[0],y1:y2,:], out[...,comps[1],y1:y2,:]
+		q[...], u[...] = c*q - s*u, s*q + c*u
+	return out
+
+def map_mul(mat, vec, out=None, bsize=0x10000):
+	"""Elementwise matrix multiplication mat*vec, where mat is
+	[...,m,n,ny,nx] and vec is [...,n,ny,nx], giving [...,m,ny,nx].
+	Any leading dimensions are broadcast. A 2d vec is treated as
+	[1,ny,nx], and a 2d result is returned in that case if m == 1.
+	The result is written to out if specified. This may be vec itself
+	(or a view of it) when m == n. The work is done in chunks of
+	about bsize pixels, with the products unrolled for m,n <= 3."""
+	mat, vec = np.asanyarray(mat), np.asanyarray(vec)
+	flat = vec.ndim == 2
+	v = vec[None] if flat else vec
+	m, n = mat.shape[-4:-2]
+	if v.shape[-3] != n:
+		raise ValueError("map_mul: mat %s and vec %s do not match" % (str(mat.shape), str(vec.shape)))
+	# Output shape from broadcasting everything except the component axes
+	bshape = np.broadcast(mat[...,0,0,:,:], v[...,0,:,:]).shape
+	oshape = bshape[:-2]+(m,)+bshape[-2:]
+	if flat and m == 1: oshape = oshape[1:]
+	if out is None: out = np.empty(oshape, np.result_type(mat.dtype, vec.dtype))
+	elif out.shape != oshape:
+		raise ValueError("map_mul: out has shape %s, expected %s" % (str(out.shape), str(oshape)))
+	o = out[None] if flat and m == 1 else out
+	# If the output overlaps the input we must go via a buffer
+	overlap = np.may_share_memory(o, v)
+	ny, nx = bshape[-2:]
+	def rows(a, y1, y2): return a[...,y1:y2,:] if a.shape[-2] > 1 else a
+	step = max(1, bsize//max(nx,1))
+	for y1 in range(0, ny, step):
+		mc, vc, oc = rows(mat,y1,y1+step), rows(v,y1,y1+step), o[...,y1:y1+step,:]
+		if m <= 3 and n <= 3:
+			work = np.empty(oc.shape, oc.dtype) if overlap else oc
+			tmp  = np.empty(oc.shape[:-3]+oc.shape[-2:], oc.dtype)
+			for i in range(m):
+				np.multiply(mc[...,i,0,:,:], vc[...,0,:,:], work[...,i,:,:])
+				for j in range(1,n):
+					np.multiply(mc[...,i,j,:,:], vc[...,j,:,:], tmp)
+					work[...,i,:,:] += tmp
+			if overlap: oc[...] = work
+		else:
+			oc[...] = np.einsum("...ijyx,...jyx->...iyx", mc, vc)
+	return samewcs(out, mat, vec)
 
 def smooth_gauss(emap, sigma):
 	"""Smooth the map given as the first argument with a gaussian beam
@@ -535,7 +734,7 @@ def create_wcs(shape, box=None, proj="cea"):
 		if proj != "plain": box *= utils.degree
 	return wcsutils.build(box, shape=shape, rowmajor=True, system=proj)
 
-def spec2flat(shape, wcs, cov, exp=1.0, mode="constant", oversample=1, smooth="auto"):
+def spec2flat(shape, wcs, cov, exp=1.0, mode="constant", oversample=1, smooth="auto", cache=True, copy=True):
 	"""Given a (ncomp,ncomp,l) power spectrum, expand it to harmonic map space,
 	returning (ncomp,ncomp,y,x). This involves a rescaling which converts from
 	power in terms of multipoles, to power in terms of 2d frequency.
@@ -551,15 +750,46 @@ def spec2flat(shape, wcs, cov, exp=1.0, mode="constant", oversample=1, smooth="a
 	  m = harm2map(map_mul(spec2flat(s, b, multi_pow(ps, 0.5), 0.5), map2harm(rand_gauss(s,b))))
 	The map m is independent of the units of harmonic space, and will be wrong unless
 	the spectrum is properly scaled. Since this scaling depends on the shape of
-	the map, this is the appropriate place to do so, ugly as it is."""
+	the map, this is the appropriate place to do so, ugly as it is.
+
+	If cache is True, the result is cached per geometry and spectrum in
+	spec2flat_cache, so repeated calls with the same arguments are cheap.
+	The cache is bounded by spec2flat_cache.maxbytes, and can be emptied
+	with clear_spec2flat_cache(). Cached results are returned as copies
+	unless copy=False, in which case the result is read-only."""
 	oshape= tuple(shape)
 	if len(oshape) == 2: oshape = (1,)+oshape
-	ls = np.sum(lmap(oshape, wcs, oversample=oversample)**2,0)**0.5
+	cov = np.asarray(cov)
+	if not cache:
+		return spec2flat_raw(oshape, wcs, cov, exp=exp, mode=mode, oversample=oversample, smooth=smooth)
+	def build():
+		res = spec2flat_raw(oshape, wcs, cov, exp=exp, mode=mode, oversample=oversample, smooth=smooth)
+		res.flags.writeable = False
+		return res
+	key = utils.cache_key("spec2flat", oshape, wcs.to_header_string(), cov, exp, mode, oversample, smooth)
+	res = spec2flat_cache.get(key, build)
+	return res.copy() if copy else res
+
+# Caches of the spec2flat results and of its |l| lookup tables,
+# bounded to 256 MB each
+spec2flat_cache = utils.lrucache(4, maxbytes=0x10000000)
+spec2flat_lgrids = utils.lrucache(4, maxbytes=0x10000000)
+
+def clear_spec2flat_cache():
+	"""Free the memory used by the spec2flat caches."""
+	spec2flat_cache.clear()
+	spec2flat_lgrids.clear()
+
+def spec2flat_raw(shape, wcs, cov, exp=1.0, mode="constant", oversample=1, smooth="auto"):
+	"""Helper for spec2flat, which does the actual work without caching."""
+	oshape= tuple(shape)
+	if len(oshape) == 2: oshape = (1,)+oshape
+	ly, lx = laxes(oshape, wcs, oversample=oversample)
 	if smooth == "auto":
 		# Determine appropriate fourier-scale smoothing based on 2d fourer
 		# space resolution. We wish to smooth by about this width to approximate
 		# averaging over sub-grid modes
-		smooth = 0.5*(ls[1,0]+ls[0,1])
+		smooth = 0.5*((ly[1]**2+lx[0]**2)**0.5+(ly[0]**2+lx[1]**2)**0.5)
 		smooth /= 3.41 # 3.41 is an empirical factor
 	if smooth > 0:
 		cov = smooth_spectrum(cov, kernel="gauss", weight="mode", width=smooth)
@@ -570,8 +800,47 @@ def spec2flat(shape, wcs, cov, exp=1.0, mode="constant", oversample=1, smooth="a
 	cov   = cov[:oshape[-3],:oshape[-3]]
 	# Use order 1 because we will perform very short interpolation, and to avoid negative
 	# values in spectra that must be positive (and it's faster)
-	res = ndmap(utils.interpol(cov, np.reshape(ls,(1,)+ls.shape),mode=mode, mask_nan=False, order=1),wcs)
-	res = downgrade(res, oversample)
+	if mode in ["constant", "nearest"]:
+		res = spec2flat_lookup(cov, ly, lx, mode)
+	else:
+		ls  = (ly[:,None]**2 + lx[None,:]**2)**0.5
+		res = utils.interpol(cov, np.reshape(ls,(1,)+ls.shape),mode=mode, mask_nan=False, order=1)
+	res = downgrade(ndmap(res, wcs), oversample)
+	return res
+
+def spec2flat_lookup(cov, ly, lx, mode="constant"):
+	"""Linearly interpolate cov[...,nl] at |l| for the 2d fourier grid
+	given by the axes ly and lx. Values beyond the end of cov are 0 for
+	mode "constant" and the last value for mode "nearest". For a symmetric
+	cov[ncomp,ncomp,nl] only the unique (i,j) pairs are interpolated."""
+	nl  = cov.shape[-1]
+	def build():
+		# |l| is symmetric under ly -> -ly for the usual fftfreq layout,
+		# in which case we only need the half-plane of non-negative ly
+		ny   = len(ly)
+		rows = np.minimum(np.arange(ny), ny-np.arange(ny))
+		if not np.array_equal(np.abs(ly[rows]), np.abs(ly)): rows = np.arange(ny)
+		half = (ly[:np.max(rows)+1,None]**2 + lx[None,:]**2)**0.5
+		i0   = np.floor(half).astype(np.int32)
+		frac = half - i0
+		if mode == "constant": frac[half > nl-1] = np.nan
+		i0   = np.minimum(i0, nl-1)
+		return i0, np.minimum(i0+1, nl-1), frac, rows
+	i0, i1, frac, rows = spec2flat_lgrids.get((ly.tobytes(), lx.tobytes(), nl, mode), build)
+	def lookup(c):
+		half = c[i0]*(1-frac) + c[i1]*frac
+		if mode == "constant": half[np.isnan(frac)] = 0
+		return half[rows]
+	res = np.empty(cov.shape[:-1]+(len(ly),len(lx)), cov.dtype)
+	if cov.ndim == 3 and len(cov) == cov.shape[1] and np.array_equal(cov, cov.transpose(1,0,2)):
+		for i in range(len(cov)):
+			for j in range(i, len(cov)):
+				res[i,j] = lookup(cov[i,j])
+				if j != i: res[j,i] = res[i,j]
+	else:
+		cflat, rflat = cov.reshape(-1,nl), res.reshape((-1,)+res.shape[-2:])
+		for i in range(len(cflat)):
+			rflat[i] = lookup(cflat[i])
 	return res
 
 def spec2flat_corr(shape, wcs, cov, exp=1.0, mode="constant"):
@@ -639,24 +908,105 @@ def _convolute_sym(a,b):
 	sb = np.concatenate([b,b[:,-2:0:-1]],-1)
 	fa = np.fft.rfft(sa)
 	fb = np.fft.rfft(sb)
-	sa = np.fft.irfft(fa*fb,sa.shape[-1],normalize=True)
+	sa = np.fft.irfft(fa*fb,sa.shape[-1])
 	return sa[:,:a.shape[-1]]
 
-def multi_pow(mat, exp, axes=[0,1]):
+def multi_pow(mat, exp, axes=[0,1], out=None, bsize=0x10000):
 	"""Raise each sub-matrix of mat (ncomp,ncomp,...) to
-	the given exponent in eigen-space."""
-	res = utils.partial_expand(svd_pow(utils.partial_flatten(mat, axes, 0), exp), mat.shape, axes, 0)
-	return samewcs(res, mat)
-
-def downgrade(emap, factor):
-	"""Returns enmap "emap" downgraded by the given integer factor
-	(may be a list for each direction, or just a number) by averaging
-	inside pixels."""
-	fact = np.full(2, 1, dtype=int)
-	fact[:] = factor
-	tshape = emap.shape[-2:]/fact*fact
-	res = np.mean(np.reshape(emap[...,:tshape[0],:tshape[1]],emap.shape[:-2]+(tshape[0]/fact[0],fact[0],tshape[1]/fact[1],fact[1])),(-3,-1))
-	return ndmap(res, emap[...,::fact[0],::fact[1]].wcs)
+	the given exponent in eigen-space, using utils.eigpow. This is done
+	in chunks of bsize matrices to limit the memory use. If out is
+	specified, the result is written there."""
+	mat = np.asanyarray(mat)
+	if out is None: out = np.empty(mat.shape, utils.float_type(mat.dtype))
+	# Work with [nmat,ncomp,ncomp] views of the input and output
+	mflat = utils.partial_flatten(mat, axes, 0)
+	with utils.flatview(out, axes, "rw") as oflat:
+		for i1 in range(0, len(mflat), bsize):
+			utils.eigpow(mflat[i1:i1+bsize], exp, out=oflat[i1:i1+bsize])
+	return samewcs(out, mat)
+
+def downgrade(emap, factor, weights=None, nan=False, bsize=0x100000, nthread=None):
+	"""Returns enmap "emap" downgraded by the given factor (may be a list
+	for each direction, or just a number) by averaging inside pixels.
+	Integer factors use a copy-free strided view of the input. Other factors
+	(e.g. 1.5) weight each input pixel by its area overlap with the output
+	pixels. Only whole output pixels are kept.
+
+	If weights (broadcastable to emap) are given, a weighted average is
+	computed. If nan is True, non-finite pixels are ignored. Output pixels
+	with no weight are NaN if nan is True, and 0 otherwise. The map is
+	processed in blocks of about bsize input pixels using nthread threads."""
+	fact  = np.zeros(2)+factor
+	ifact = np.round(fact).astype(int)
+	exact = np.all(np.abs(fact-ifact) < 1e-10)
+	if exact: fact = ifact
+	if np.any(fact <= 0): raise ValueError("downgrade factor must be positive")
+	ishape= emap.shape[-2:]
+	oshape= np.floor(np.array(ishape)/fact.astype(float)+1e-6).astype(int)
+	odtype= np.result_type(utils.float_type(emap.dtype), emap.dtype)
+	owcs  = wcsutils.scale(emap.wcs, 1.0/fact, rowmajor=True)
+	res   = ndmap(np.empty(emap.shape[:-2]+tuple(oshape), odtype), owcs)
+	if weights is not None: weights = np.broadcast_to(weights, emap.shape)
+	if not exact:
+		# Area overlap between output and input pixels along each axis
+		rmats = [_downgrade_overlap(ishape[i], fact[i], oshape[i]) for i in range(2)]
+	# Number of output rows per block
+	npre = int(np.prod(emap.shape[:-2]))
+	nrow = max(1, int(bsize//max(1,npre*ishape[1]*fact[0])))
+	def work(oy1):
+		oy2 = min(oy1+nrow, oshape[0])
+		iy1, iy2 = int(np.floor(oy1*fact[0]+1e-6)), min(int(np.ceil(oy2*fact[0]-1e-6)), ishape[0])
+		ix2 = min(int(np.ceil(oshape[1]*fact[1]-1e-6)), ishape[1])
+		m = emap[...,iy1:iy2,:ix2]
+		w = weights[...,iy1:iy2,:ix2] if weights is not None else None
+		if nan:
+			good = np.isfinite(m)
+			m = np.where(good, m, 0)
+			w = good if w is None else w*good
+		if exact: rsum = lambda a: np.sum(_downgrade_view(a, fact), (-3,-1), dtype=odtype)
+		else:
+			ry = rmats[0][oy1:oy2,iy1:iy2].toarray()
+			rsum = lambda a: _downgrade_apply(a, ry, rmats[1][:,:ix2])
+		o = res[...,oy1:oy2,:]
+		if w is None:
+			o[...] = rsum(m)
+			o /= np.prod(fact)
+		else:
+			wsum = rsum(np.broadcast_to(w, m.shape))
+			o[...] = rsum(m*w)
+			with np.errstate(invalid="ignore", divide="ignore"):
+				o /= wsum
+			o[wsum == 0] = np.nan if nan else 0
+	utils.threaded_map(work, range(0, oshape[0], nrow), nthread)
+	return res
+
+def _downgrade_view(a, fact):
+	"""Return a [...,ny,fy,nx,fx] view of a[...,ny*fy,nx*fx] without copying."""
+	st = a.strides
+	return np.lib.stride_tricks.as_strided(a,
+		shape  =a.shape[:-2]+(a.shape[-2]//fact[0],fact[0],a.shape[-1]//fact[1],fact[1]),
+		strides=st[:-2]+(st[-2]*fact[0],st[-2],st[-1]*fact[1],st[-1]))
+
+def _downgrade_overlap(n, f, on):
+	"""Sparse [on,n] matrix with the overlap between output pixels
+	of width f and the input pixels of width 1."""
+	import scipy.sparse
+	oi = np.arange(on)
+	rows, cols, vals = [], [], []
+	for k in range(int(np.ceil(f))+1):
+		ii = np.floor(oi*f+1e-6).astype(int)+k
+		ov = np.minimum(ii+1, (oi+1)*f) - np.maximum(ii, oi*f)
+		ok = (ov > 1e-6) & (ii < n)
+		rows.append(oi[ok]); cols.append(ii[ok]); vals.append(ov[ok])
+	return scipy.sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(on,n))
+
+def _downgrade_apply(a, ry, rx):
+	"""Apply the dense overlap matrix ry[oy,ny] and sparse rx[ox,nx]
+	to the last two axes of a[...,ny,nx]."""
+	a  = np.tensordot(ry, a, (1,-2))
+	a  = utils.moveaxis(a, 0, -2)
+	af = a.reshape(-1, a.shape[-1])
+	return rx.dot(af.T).T.reshape(a.shape[:-1]+(rx.shape[0],))
 
 def upgrade(emap, factor):
 	"""Upgrade emap to a larger size using nearest neighbor interpolation,
@@ -666,13 +1016,8 @@ def upgrade(emap, factor):
 	fact[:] = factor
 	res = np.tile(emap.copy().reshape(emap.shape[:-2]+(emap.shape[-2],1,emap.shape[-1],1)),(1,fact[0],1,fact[1]))
 	res = res.reshape(res.shape[:-4]+(np.product(res.shape[-4:-2]),np.product(res.shape[-2:])))
-	# Correct the WCS information
-	for j in range(2):
-		res.wcs.wcs.crpix[j] -= 0.5
-		res.wcs.wcs.crpix[j] *= fact[1-j]
-		res.wcs.wcs.cdelt[j] /= fact[1-j]
-		res.wcs.wcs.crpix[j] += 0.5
-	return res
+	# Correct the WCS information. res shares the wcs of emap, so use a copy
+	return ndmap(res, wcsutils.scale(emap.wcs, fact, rowmajor=True))
 
 def pad(emap, pix, return_slice=False,wrap=False):
 	"""Pad enmap "emap", creating a larger map with zeros filled in on the sides.
@@ -699,24 +1044,47 @@ def pad(emap, pix, return_slice=False,wrap=False):
 		res[...,:,-pix[1,1]:] = res[...,:,pix[0,1]:pix[0,1]+pix[1,1]]
 	return (res,mslice) if return_slice else res
 
+def _count_blank_lines(m, value, axis, reverse=False, bsize=0x100000):
+	"""Helper for autocrop. Returns the number of rows (axis=-2) or columns
+	(axis=-1) of m[...,ny,nx] at the start (or end if reverse) that entirely
+	consist of value[...]. The lines are read in chunks that start small and
+	grow up to about bsize pixels, stopping at the first non-blank line."""
+	n     = m.shape[axis]
+	nline = max(1, bsize//max(1, m.size//max(1,n)))
+	i, step = 0, 1
+	while i < n:
+		w   = min(step, n-i)
+		sel = slice(n-i-w, n-i) if reverse else slice(i, i+w)
+		chunk = m[...,sel,:] if axis == -2 else m[...,sel]
+		hit = np.isclose(chunk, value[...,None,None], equal_nan=True, rtol=1e-6, atol=0)
+		# Reduce over everything except the line axis
+		hit = utils.moveaxis(hit, axis, 0).reshape(w,-1)
+		hit = np.all(hit,1)
+		if reverse: hit = hit[::-1]
+		bad = np.where(~hit)[0]
+		if len(bad) > 0: return i + bad[0]
+		i   += w
+		step = min(2*step, nline)
+	return n
+
 def autocrop(m, method="plain", value="auto", margin=0, factors=None, return_info=False):
 	"""Adjust the size of m to be more fft-friendly. If possible,
 	blank areas at the edge of the map are cropped to bring us to a nice
 	length. If there there aren't enough blank areas, the map is padded
 	instead."""
 	def calc_blanks(m, value):
-		value   = np.asarray(value)
-		# Find which rows and cols consist entirely of the given value
-		hitmask = np.all(np.isclose(m.T, value.T, equal_nan=True, rtol=1e-6, atol=0).T,axis=tuple(range(m.ndim-2)))
-		hitrows = np.all(hitmask,1)
-		hitcols = np.all(hitmask,0)
-		# Find the first and last row and col which aren't all the value
-		blanks  = np.array([
-			np.where(~hitrows)[0][[0,-1]],
-			np.where(~hitcols)[0][[0,-1]]]
-			).T
-		blanks[1] = m.shape[-2:]-blanks[1]-1
-		return blanks
+		# Count the blank rows at each end first, and then the blank columns
+		# inside the remaining rows, so only the blank borders are read.
+		value  = np.asarray(value)
+		ny, nx = m.shape[-2:]
+		top    = _count_blank_lines(m, value, -2)
+		# An entirely blank map has nothing sensible to crop to
+		if top == ny: return np.zeros((2,2),int)
+		bot    = _count_blank_lines(m[...,top:,:], value, -2, reverse=True)
+		rows   = m[...,top:ny-bot,:]
+		left   = _count_blank_lines(rows, value, -1)
+		right  = _count_blank_lines(rows[...,left:], value, -1, reverse=True)
+		return np.array([[top,left],[bot,right]])
 	if value == "auto":
 		# Find the median value along each edge
 		medians = [np.median(m[...,:,i],-1) for i in [0,-1]] + [np.median(m[...,i,:],-1) for i in [0,-1]]
@@ -799,23 +1167,82 @@ def apod(m, width, profile="cos", fill="zero"):
 		res += offset
 	return res
 
-def radial_average(map, center=[0,0], step=1.0):
-	"""Produce a radial average of the given map that's centered on zero"""
-	center = np.asarray(center)
-	pos  = map.posmap()-center[:,None,None]
+def radial_average(map, center=[0,0], step=1.0, bins=None, weights=None, return_counts=False):
+	"""Produce a radial average of the given map[...,ny,nx] around center
+	(dec,ra). By default the bins are step times the highest resolution
+	direction wide, and cover the distance to the farthest full bin. Arbitrary
+	bin edges can be passed as bins instead. Returns mout[...,nbin], orads[nbin],
+	where orads are the lower bin edges, and also the number of pixels (or
+	the sum of the weights) in each bin if return_counts is True. All the leading
+	dimensions of map, e.g. [nstamp,ncomp], are handled in one go, and the bins
+	are only computed once per geometry."""
+	binfo = radial_bins(map.shape, map.wcs, center, step=step, bins=bins)
+	res   = bin_profile(map, binfo, weights=weights, return_counts=return_counts)
+	orads = binfo.edges[:-1]
+	return (res[0], orads, res[1]) if return_counts else (res, orads)
+
+class radial_bins:
+	"""The radial bins of a geometry, as used by radial_average and bin_profile.
+	The members are edges[nbin+1], pixel bin indices inds[ny*nx] (-1 for pixels
+	outside all bins) and the sparse [nbin,ny*nx] binning matrix bmat. These are
+	cached per geometry, so constructing the same bins again is cheap."""
+	def __init__(self, shape, wcs, center=[0,0], step=1.0, bins=None):
+		key = utils.cache_key("radial_bins", tuple(shape[-2:]), wcs.to_header_string(),
+				np.asarray(center, float), step, None if bins is None else np.asarray(bins, float))
+		self.edges, self.inds, self.bmat = radial_bins_cache.get(key,
+				lambda: radial_bins_raw(shape, wcs, center, step=step, bins=bins))
+	@property
+	def nbin(self): return len(self.edges)-1
+
+radial_bins_cache = utils.lrucache(8)
+
+def radial_bins_raw(shape, wcs, center=[0,0], step=1.0, bins=None):
+	"""Helper for radial_bins. Returns edges, inds, bmat."""
+	center = np.asarray(center, float)
+	pos  = posmap(shape[-2:], wcs)
+	pos -= center[:,None,None]
 	rads = np.sum(pos**2,0)**0.5
-	# Our resolution should be step times the highest resolution direction.
-	res = np.min(map.extent()/map.shape[-2:])*step
-	n   = int(np.max(rads/res))
-	orads = np.arange(n)*res
-	rinds = (rads/res).reshape(-1).astype(int)
-	# Ok, rebin the map. We use this using bincount, which can be a bit slow
-	mflat = map.reshape((-1,)+map.shape[-2:])
-	mout = np.zeros((len(mflat),n))
-	for i, m in enumerate(mflat):
-		mout[i] = (np.bincount(rinds, weights=m.reshape(-1))/np.bincount(rinds))[:n]
-	mout = mout.reshape(map.shape[:-2]+mout.shape[1:])
-	return mout, orads
+	del pos
+	if bins is None:
+		# Our resolution should be step times the highest resolution direction.
+		res  = np.min(extent(shape, wcs)/shape[-2:])*step
+		nbin = int(np.max(rads/res))
+		edges= np.arange(nbin+1)*res
+		inds = (rads/res).reshape(-1).astype(int)
+	else:
+		edges= np.asarray(bins, float)
+		nbin = len(edges)-1
+		inds = np.searchsorted(edges, rads.reshape(-1), side="right")-1
+	inds[(inds < 0) | (inds >= nbin)] = -1
+	return edges, inds, bin_matrix(inds, nbin)
+
+def bin_matrix(inds, nbin):
+	"""Sparse [nbin,npix] matrix that sums the pixels with each bin index.
+	Pixels with negative indices are skipped."""
+	import scipy.sparse
+	good = np.where(inds >= 0)[0]
+	return scipy.sparse.csr_matrix((np.ones(len(good)), (inds[good], good)), shape=(nbin, inds.size))
+
+def bin_profile(map, bins, weights=None, return_counts=False):
+	"""Average map[...,ny,nx] inside the pixel bins given by bins, which is
+	either a radial_bins object or an integer array of bin indices [ny,nx]
+	(negative for pixels to skip). All leading dimensions of map are reduced
+	in a single sparse matrix product. If weights[ny,nx] is specified, a
+	weighted average is computed. Returns mout[...,nbin], and also the
+	number of pixels (sum of weights) in each bin if return_counts is True.
+	Empty bins are NaN."""
+	if isinstance(bins, radial_bins): bmat = bins.bmat
+	else:
+		inds = np.asarray(bins).reshape(-1)
+		bmat = bin_matrix(inds, np.max(inds)+1 if inds.size > 0 else 0)
+	mflat = np.asarray(map).reshape(-1, map.shape[-2]*map.shape[-1])
+	if weights is not None:
+		bmat = bmat.multiply(np.asarray(weights).reshape(1,-1)).tocsr()
+	counts = np.asarray(bmat.sum(1)).reshape(-1)
+	sums   = bmat.dot(mflat.T).T
+	with np.errstate(invalid="ignore", divide="ignore"):
+		mout = (sums/counts).reshape(map.shape[:-2]+(len(counts),))
+	return (mout, counts) if return_counts else mout
 
 def padslice(map, box, default=np.nan):
 	"""Equivalent to map[...,box[0,0]:box[1,0],box[0,1]:box[1,1]], except that
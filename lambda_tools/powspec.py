@@ -1,34 +1,51 @@
-import numpy as np
+import numpy as np, os
 from . import utils
 
-def sym_compress(mat, which=None, n=None, scheme=None, axes=[0,1]):
+def sym_compress(mat, which=None, n=None, scheme=None, axes=[0,1], out=None):
 	"""Extract the unique elements of a symmetric matrix, and
 	return them as a flat array. For multidimensional arrays,
 	the extra dimensions keep their shape. The optional argument
 	'which' indicates the compression scheme, as returned by
 	compressed_order. The optional argument 'n' indicates the
 	number of elements to keep (the default is to keep all unique
-	elements). The 'axes' argument indicates which axes to operate on."""
-	if n is None: n = mat.shape[axes[0]]*(mat.shape[axes[0]]+1)/2
-	if which==None: which = compressed_order(n, scheme)
-	m = np.rollaxis(np.rollaxis(mat, axes[1]), axes[0])
-	res = np.array([m[w[0],w[1]] for w in which])
-	return np.rollaxis(res, 0, axes[0])
-
-def sym_expand(mat, which=None, ncomp=None, scheme=None, axis=0):
+	elements). The 'axes' argument indicates which axes to operate on.
+	The compressed axis is placed at the position of axes[0]. If out
+	is specified, the result is written there."""
+	mat = np.asanyarray(mat)
+	std = list(axes) == [0,1]
+	m   = mat if std else utils.moveaxes(mat, axes, [0,1])
+	if n is None: n = m.shape[0]*(m.shape[0]+1)//2
+	which = get_order(n, scheme) if which is None else np.asarray(which)
+	# We read the lower triangle, like earlier versions did
+	inds  = which[:,1]*m.shape[1] + which[:,0]
+	if out is None: out = np.empty((len(which),)+m.shape[2:], mat.dtype)
+	elif not std: out = utils.moveaxis(out, axes[0], 0)
+	try:
+		# Fast path: treat the two matrix axes as a single one
+		mflat = m.view()
+		mflat.shape = (-1,)+m.shape[2:]
+		np.take(mflat, inds, 0, out=out)
+	except AttributeError:
+		out[...] = m[which[:,1],which[:,0]]
+	return out if std else utils.moveaxis(out, 0, axes[0])
+
+def sym_expand(mat, which=None, ncomp=None, scheme=None, axis=0, out=None):
 	"""The inverse of sym_compress. Expands a flat array of numbers
 	into a symmetric matrix with ncomp components using the given
-	mapping which (or construct one using the given scheme)."""
-	if which==None: which = compressed_order(mat.shape[axis], scheme=scheme)
-	if ncomp==None: ncomp = np.max(which)+1
-	m = np.rollaxis(mat, axis)
-	shape = [ncomp,ncomp] + list(m.shape[1:])
-	res = np.zeros(shape,dtype=mat.dtype)
-	for i, w in enumerate(which):
-		res[w[0],w[1]] = m[i]
-		if w[0] != w[1]:
-			res[w[1],w[0]] = m[i]
-	return np.rollaxis(np.rollaxis(res, 1, axis), 0, axis)
+	mapping which (or construct one using the given scheme). The
+	two new axes are placed at position axis. If out is specified,
+	the result is written there."""
+	mat = np.asanyarray(mat)
+	m   = mat if axis == 0 else utils.moveaxis(mat, axis, 0)
+	which = get_order(len(m), scheme) if which is None else np.asarray(which)
+	if ncomp is None: ncomp = np.max(which)+1
+	if out is None: res = np.zeros((ncomp,ncomp)+m.shape[1:], mat.dtype)
+	else:
+		res = out if axis == 0 else utils.moveaxes(out, [axis,axis+1], [0,1])
+		res[...] = 0
+	res[which[:,0],which[:,1]] = m
+	res[which[:,1],which[:,0]] = m
+	return res if axis == 0 else utils.moveaxes(res, [0,1], [axis,axis+1])
 
 def sym_expand_camb_full_lens(a):
 	# This complicated ordering doesn't fit into any of our expansion patterns,
@@ -79,7 +96,23 @@ def compressed_order(n, scheme=None):
 		00 01 02 11 22
 		00 01 02 11 12 22
 		..."""
-	if scheme == None: scheme = "diag"
+	return get_order(n, scheme).tolist()
+
+# Memoized compressed orders, indexed by (n, scheme)
+compressed_orders = {}
+
+def get_order(n, scheme=None):
+	"""As compressed_order, but returns a memoized read-only
+	integer array which[n,2] instead of a list."""
+	if scheme is None: scheme = "diag"
+	key = (n, scheme)
+	if key not in compressed_orders:
+		which = np.array(build_order(n, scheme), dtype=int).reshape(-1,2)
+		which.flags.writeable = False
+		compressed_orders[key] = which
+	return compressed_orders[key]
+
+def build_order(n, scheme):
 	# nfull = ncomp*(ncomp+1)/2 =>
 	# ncomp = (-1+sqrt(1+8*nfull))/2
 	ncomp = int(np.ceil((-1+(1+8*n)**0.5)/2))
@@ -127,7 +160,32 @@ def scale_camb_scalar_phi(a, direction):
 	a[...,0] = 0
 	return a
 
-def read_spectrum(fname, inds=True, scale=True, expand="diag", ncol=None, ncomp=None):
+# Maximum size in bytes of the on-disk cache used by cached_read
+spectrum_cache_size = 1<<30
+
+def cached_read(reader, fname, **kwargs):
+	"""Return reader(fname, cache=False, **kwargs), using an on-disk binary
+	cache keyed by the file's path, modification time and size and the
+	reader options. The result is a normal in-memory array either way."""
+	cdir = utils.cache_dir("powspec")
+	try: stat = os.stat(fname)
+	except (OSError, TypeError): cdir = None
+	if cdir is None: return reader(fname, cache=False, **kwargs)
+	key   = utils.cache_key(reader.__name__, 1, os.path.abspath(fname), stat.st_mtime,
+			stat.st_size, sorted(kwargs.items()))
+	cname = os.path.join(cdir, key + ".npy")
+	try: return np.load(cname)
+	except (IOError, OSError, ValueError): pass
+	res = reader(fname, cache=False, **kwargs)
+	tmpname = "%s.%d.tmp" % (cname, os.getpid())
+	try:
+		with open(tmpname, "wb") as f: np.save(f, res)
+		os.rename(tmpname, cname)
+		utils.cache_evict(cdir, spectrum_cache_size)
+	except (IOError, OSError): pass
+	return res
+
+def read_spectrum(fname, inds=True, scale=True, expand="diag", ncol=None, ncomp=None, cache=True):
 	"""Read a power spectrum from disk and return a dense
 	array cl[nspec,lmax+1]. Unless scale=False, the spectrum
 	will be multiplied by 2pi/l/(l+1) when being read.
@@ -135,7 +193,9 @@ def read_spectrum(fname, inds=True, scale=True, expand="diag", ncol=None, ncomp=
 	to be the indices. If expand!=None, it can be one of the
 	valid expansion schemes from compressed_order, and will
 	cause the returned array to be cl[ncomp,ncomp,lmax+1]
-	instaed."""
+	instaed. Unless cache=False, the result is cached on disk
+	(see cached_read), so later reads of the same file are fast."""
+	if cache: return cached_read(read_spectrum, fname, inds=inds, scale=scale, expand=expand, ncol=ncol, ncomp=ncomp)
 	a = np.atleast_2d(np.loadtxt(fname).T)
 	if inds: a = expand_inds(np.array(a[0],dtype=int), a[1:])
 	if scale: a = scale_spectrum(a, 1)
@@ -143,25 +203,26 @@ def read_spectrum(fname, inds=True, scale=True, expand="diag", ncol=None, ncomp=
 	if expand is not None: a = sym_expand(a, scheme=expand, ncomp=ncomp)
 	return a
 
-def read_phi_spectrum(fname, coloff=0, inds=True, scale=True, expand="diag"):
-	a = read_spectrum(fname, inds=inds, scale=False, expand=None)[coloff]
+def read_phi_spectrum(fname, coloff=0, inds=True, scale=True, expand="diag", cache=True):
+	a = read_spectrum(fname, inds=inds, scale=False, expand=None, cache=cache)[coloff]
 	if scale: a = scale_camb_scalar_phi(a, 1)
 	if expand is not None: a = a[None,None]
 	return a
 
-def read_camb_scalar(fname, inds=True, scale=True, expand=True, ncmb=3):
+def read_camb_scalar(fname, inds=True, scale=True, expand=True, ncmb=3, cache=True):
 	"""Read the information in the camb scalar outputs. This contains
 	the cmb and lensing power spectra, but not their correlation. They
 	are therefore returned as two separate arrays."""
 	if expand: expand = "diag"
-	ps_cmb  = read_spectrum(fname, inds=inds, scale=scale, expand=expand, ncol=ncmb, ncomp=3)
-	ps_lens = read_phi_spectrum(fname, inds=inds, scale=scale, expand=expand, coloff=ncmb)
+	ps_cmb  = read_spectrum(fname, inds=inds, scale=scale, expand=expand, ncol=ncmb, ncomp=3, cache=cache)
+	ps_lens = read_phi_spectrum(fname, inds=inds, scale=scale, expand=expand, coloff=ncmb, cache=cache)
 	return ps_cmb, ps_lens
 
-def read_camb_full_lens(fname, inds=True, scale=True, expand=True, ncmb=3):
+def read_camb_full_lens(fname, inds=True, scale=True, expand=True, ncmb=3, cache=True):
 	"""Reads the CAMB lens_potential_output spectra, which contain
 	l TT EE BB TE dd dT dE. These are rescaled appropriately is scale is True, and returned
-	as [T,E,B,d] if expand is True."""
+	as [T,E,B,d] if expand is True. The result is cached as in read_spectrum."""
+	if cache: return cached_read(read_camb_full_lens, fname, inds=inds, scale=scale, expand=expand, ncmb=ncmb)
 	a = np.loadtxt(fname, ndmin=2).T
 	if inds: a = expand_inds(a[0].astype(int), a[1:])
 	if scale:
@@ -176,9 +237,14 @@ def write_spectrum(fname, spec, inds=True, scale=True, expand="diag"):
 	if scale: spec = scale_spectrum(spec, -1)
 	if expand is not None: spec = sym_compress(spec, scheme=expand)
 	if inds: spec = np.concatenate([np.arange(spec.shape[-1])[None],spec],0)
-	np.savetxt(fname, spec.T, fmt="%15.7e")
+	# Same output as np.savetxt(fname, spec.T, fmt="%15.7e"), but formatted
+	# in a single operation instead of row by row
+	spec = np.asarray(spec).reshape(-1, spec.shape[-1])
+	line = " ".join(["%15.7e"]*len(spec)) + "\n"
+	with open(fname, "w") as f:
+		f.write((line*spec.shape[1]) % tuple(spec.T.reshape(-1)))
 
-def spec2corr(spec, pos, iscos=False, symmetric=True):
+def spec2corr(spec, pos, iscos=False, symmetric=True, nthread=None):
 	"""Compute the correlation function sum(2l+1)/4pi Cl Pl(cos(theta))
 	corresponding to the given power spectrum at the given positions."""
 	spec = np.asarray(spec)
@@ -188,8 +254,46 @@ def spec2corr(spec, pos, iscos=False, symmetric=True):
 	else: fspec = spec.reshape(-1,spec.shape[-1])
 	l = np.arange(spec.shape[-1])
 	weight = (2*l+1)/(4*np.pi)
-	res = np.zeros(fspec.shape[:1]+pos.shape)
-	for i, cl in enumerate(fspec):
-		res[i] = np.polynomial.legendre.legval(pos, weight*cl)
+	res = legendre_sum(weight*fspec, pos, nthread=nthread)
 	if symmetric: res = sym_expand(res)
 	return res
+
+def legendre_sum(coeffs, x, bsize=0x4000, lblock=64, nthread=None):
+	"""Evaluate the Legendre series sum_l coeffs[...,l] P_l(x) for all the
+	series in coeffs[...,nl] at once, returning res[...,{x.shape}]. This
+	is equivalent to calling np.polynomial.legendre.legval for each series,
+	but the Legendre polynomials are only computed once. They are built with
+	the forward recurrence in blocks of lblock multipoles, which are then
+	accumulated with a matrix product. The positions are processed in
+	chunks of bsize, distributed over nthread threads."""
+	coeffs = np.asarray(coeffs, dtype=np.float64)
+	x      = np.asarray(x, dtype=np.float64)
+	cflat  = coeffs.reshape(-1, coeffs.shape[-1])
+	xflat  = x.reshape(-1)
+	res    = np.empty((len(cflat), xflat.size))
+	def work(i1):
+		res[:,i1:i1+bsize] = legendre_sum_block(cflat, xflat[i1:i1+bsize], lblock)
+	utils.threaded_map(work, range(0, xflat.size, bsize), nthread)
+	return res.reshape(coeffs.shape[:-1]+x.shape)
+
+def legendre_sum_block(coeffs, x, lblock=64):
+	"""Helper for legendre_sum. Evaluates the series coeffs[nspec,nl] at
+	x[n], returning res[nspec,n]."""
+	nl  = coeffs.shape[-1]
+	res = np.zeros((len(coeffs), len(x)))
+	# Row 2+i holds P_{l1+i}, and rows 0 and 1 hold the two preceding
+	# polynomials, which the recurrence needs.
+	buf = np.zeros((lblock+2, len(x)))
+	for l1 in range(0, nl, lblock):
+		l2 = min(l1+lblock, nl)
+		for l in range(l1, l2):
+			i = l-l1+2
+			if l == 0: buf[i] = 1
+			else:
+				# l P_l = (2l-1) x P_{l-1} - (l-1) P_{l-2}
+				np.multiply(x, buf[i-1], out=buf[i])
+				buf[i] *= (2*l-1.0)/l
+				buf[i] -= ((l-1.0)/l)*buf[i-2]
+		res += coeffs[:,l1:l2].dot(buf[2:2+l2-l1])
+		buf[:2] = buf[l2-l1:l2-l1+2]
+	return res
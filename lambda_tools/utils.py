@@ -1,4 +1,58 @@
-import numpy as np, scipy.ndimage, os, errno, scipy.optimize, time, datetime, warnings, sys
+import numpy as np, os, errno, time, datetime, warnings, sys
+
+class lazy_module(object):
+	"""Stand-in for the module with the given name, which is only imported
+	when one of its attributes is first used. This keeps heavy or optional
+	dependencies from slowing down (or breaking) our own imports. Submodules
+	are looked up the same way, so lazy_module("scipy").ndimage.map_coordinates
+	works without importing scipy.ndimage up front. If onload is specified,
+	it is called with the module right after it has been imported."""
+	def __init__(self, name, onload=None):
+		self.__dict__.update(_name=name, _onload=onload, _module=None)
+	def _load(self):
+		if self._module is None:
+			import importlib
+			module = importlib.import_module(self._name)
+			if self._onload is not None: self._onload(module)
+			self.__dict__["_module"] = module
+		return self._module
+	def __getattr__(self, attr):
+		module = self._load()
+		try: return getattr(module, attr)
+		except AttributeError: pass
+		# Not imported yet. Try it as a submodule
+		sub = lazy_module(self._name + "." + attr)
+		try: sub._load()
+		except ImportError: raise AttributeError("module %s has no attribute %s" % (self._name, attr))
+		self.__dict__[attr] = sub
+		return sub
+	def __setattr__(self, attr, val): setattr(self._load(), attr, val)
+	def __repr__(self): return "<lazy module '%s'>" % self._name
+
+class _lazy_class(type):
+	"""Metaclass of the stand-ins made by lazy_class."""
+	def __new__(mcs, name, bases, dict):
+		real = [b._resolve() if isinstance(b, mcs) else b for b in bases]
+		if real == list(bases): return type.__new__(mcs, name, bases, dict)
+		# Subclassing a stand-in makes a subclass of the real class
+		return type(real[0])(name, tuple(real), dict)
+	def _resolve(cls): return getattr(cls._module, cls._name)
+	def __call__(cls, *args, **kwargs): return cls._resolve()(*args, **kwargs)
+	def __instancecheck__(cls, obj): return isinstance(obj, cls._resolve())
+	def __subclasscheck__(cls, sub): return issubclass(sub, cls._resolve())
+	def __getattr__(cls, attr):
+		if attr.startswith("__"): raise AttributeError(attr)
+		return getattr(cls._resolve(), attr)
+
+def lazy_class(module, name):
+	"""Stand-in for the class with the given name in module, which is
+	usually a lazy_module, so that the class is only looked up when it is
+	first used. Calling the stand-in constructs an instance of the real
+	class, and isinstance, issubclass and subclassing all refer to the real
+	class, as do other attribute lookups."""
+	return _lazy_class(name, (object,), {"_module": module, "_name": name})
+
+scipy = lazy_module("scipy")
 
 degree = np.pi/180
 arcmin = degree/60
@@ -273,11 +327,42 @@ def dedup(a):
 	The original is not modified."""
 	return a[np.concatenate([[True],a[1:]!=a[:-1]])]
 
-def interpol(a, inds, order=3, mode="nearest", mask_nan=True, cval=0.0, prefilter=True):
+def float_type(dtype):
+	"""Return the floating point type used for coordinates and other
+	derived quantities of arrays with the given dtype: single precision
+	input (float32 or complex64) gives float32, everything else float64."""
+	return np.float32 if np.dtype(dtype) in [np.float32, np.complex64] else np.float64
+
+def sanitize(a, vals=[], fill=0, scale=1, rtol=1e-5, atol=1e-8, inplace=True, bsize=0x100000):
+	"""Replace non-finite values in a, as well as values close to any of
+	the sentinel values vals (as defined by np.isclose with rtol and atol),
+	by fill, and multiply everything else by scale. This is done in a
+	single pass over a in blocks of bsize elements, so no full-size
+	temporaries are created. a is modified in place unless inplace is False
+	or a is not writable. Returns the result."""
+	a = np.asanyarray(a)
+	if not inplace or not a.flags.writeable: a = a.copy()
+	# nditer hands us 1d blocks in memory order, buffering them only if a
+	# is not contiguous, so this works in place for any memory layout
+	it = np.nditer(a, flags=["external_loop","buffered","zerosize_ok"], op_flags=[["readwrite"]], buffersize=bsize)
+	for block in it:
+		bad   = ~np.isfinite(block)
+		with np.errstate(invalid="ignore"):
+			for val in vals:
+				bad |= np.abs(block-val) <= atol + rtol*np.abs(val)
+		if scale != 1: block *= scale
+		block[bad] = fill
+	del it
+	return a
+
+def interpol(a, inds, order=3, mode="nearest", mask_nan=True, cval=0.0, prefilter=True, wrap=False):
 	"""Given an array a[{x},{y}] and a list of
 	float indices into a, inds[len(y),{z}],
 	returns interpolated values at these positions
-	as [{x},{z}]."""
+	as [{x},{z}]. If wrap is True, the last axis of a
+	is periodic with a period equal to its length, e.g.
+	for a map that covers all RA. This is handled without
+	padding a, unlike mode="wrap", which wraps all axes."""
 	a    = np.asanyarray(a)
 	inds = np.asanyarray(inds)
 	inds_orig_nd = inds.ndim
@@ -289,26 +374,175 @@ def interpol(a, inds, order=3, mode="nearest", mask_nan=True, cval=0.0, prefilte
 	if mask_nan:
 		mask = ~np.isfinite(fa)
 		fa[mask] = 0
+	if order <= 1 and inds.shape[0] <= 2 and mode in ["nearest","constant"]:
+		# Fast path that handles all components at once
+		fr[:] = interpol_linear(fa, inds, order=order, mode=mode, cval=cval, wrap=wrap)
+		if mask_nan and np.sum(mask) > 0:
+			fr[interpol_linear(mask, inds, order=0, mode=mode, cval=cval, wrap=wrap)] = np.nan
+		if inds_orig_nd == 1: res = res[...,0]
+		return res
+	if wrap:
+		# Prefilter periodically ourselves, so the evaluation below is local
+		npad = 0
+		if prefilter and order > 1: fa, npad = interpol_prefilter(fa, npre=1, order=order, wrap=True, mode=mode, pad=True)
+		def interp(arr, order): return interpol_wrap(arr, inds, order=order, mode=mode, cval=cval, npad=npad if order > 1 else 0)
+	else:
+		def interp(arr, order): return scipy.ndimage.map_coordinates(arr, inds, order=order, mode=mode, cval=cval, prefilter=prefilter)
 	for i in range(fa.shape[0]):
-		fr[i].real = scipy.ndimage.map_coordinates(fa[i].real, inds, order=order, mode=mode, cval=cval, prefilter=prefilter)
+		fr[i].real = interp(fa[i].real, order)
 		if np.iscomplexobj(fa[i]):
-			fr[i].imag = scipy.ndimage.map_coordinates(fa[i].imag, inds, order=order, mode=mode, cval=cval, prefilter=prefilter)
+			fr[i].imag = interp(fa[i].imag, order)
 	if mask_nan and np.sum(mask) > 0:
 		fmask = np.empty(fr.shape,dtype=bool)
 		for i in range(mask.shape[0]):
-			fmask[i] = scipy.ndimage.map_coordinates(mask[i], inds, order=0, mode=mode, cval=cval, prefilter=prefilter)
+			fmask[i] = interp(mask[i], 0)
 		fr[fmask] = np.nan
 	if inds_orig_nd == 1: res = res[...,0]
 	return res
 
-def interpol_prefilter(a, npre=None, order=3, inplace=False):
+def interpol_linear(a, inds, order=1, mode="nearest", cval=0.0, wrap=False, bsize=0x10000, nthread=None):
+	"""Nearest neighbor (order 0) or linear (order 1) interpolation of
+	a[...,{y}] at the float indices inds[len(y),{z}], returning [...,{z}]
+	like interpol, but without going through scipy. All the leading
+	components of a are gathered together, the result has the same dtype
+	as a, with single precision input interpolated in single precision, and
+	the positions are processed in blocks of bsize using nthread threads.
+	mode can be "nearest" or "constant", with the same meaning as for
+	scipy.ndimage.map_coordinates. If wrap is True, the last axis of a
+	is periodic."""
+	a     = np.asarray(a)
+	inds  = np.asarray(inds)
+	ndim  = inds.shape[0]
+	shape = a.shape[a.ndim-ndim:]
+	af    = a.reshape(-1, int(np.prod(shape)))
+	pflat = inds.reshape(ndim, -1)
+	res   = np.empty((len(af), pflat.shape[1]), a.dtype)
+	wtype = float_type(a.dtype)
+	# Distance between neighbors along each axis in the flattened array
+	steps = np.cumprod((shape[1:]+(1,))[::-1])[::-1]
+	def work(i1):
+		p   = pflat[:,i1:i1+bsize]
+		bad = np.zeros(p.shape[1], bool)
+		# Build the flat index and weight of each corner of the interpolation cell
+		corners = [(0, None)]
+		for d in range(ndim):
+			n, x = shape[d], p[d]
+			periodic = wrap and d == ndim-1
+			if mode == "constant" and not periodic: bad |= (x < 0) | (x > n-1)
+			if order == 0: opts = [(np.floor(x+0.5).astype(int), None)]
+			else:
+				i0 = np.floor(x)
+				w1 = (x-i0).astype(wtype)
+				i0 = i0.astype(int)
+				opts = [(i0, 1-w1), (i0+1, w1)]
+			ncorn = []
+			for ind, w in opts:
+				ind = ind % n if periodic else np.clip(ind, 0, n-1)
+				for off, cw in corners:
+					ncorn.append((off + ind*steps[d], w if cw is None else cw*w))
+			corners = ncorn
+		r = res[:,i1:i1+bsize]
+		if order == 0: r[:] = af.take(corners[0][0], 1)
+		else:
+			acc = af.take(corners[0][0], 1)*corners[0][1]
+			for off, w in corners[1:]:
+				acc += af.take(off, 1)*w
+			r[:] = acc
+		if np.any(bad): r[:,bad] = cval
+	threaded_map(work, range(0, pflat.shape[1], bsize), nthread)
+	return res.reshape(a.shape[:a.ndim-ndim]+inds.shape[1:])
+
+def interpol_wrap(a, inds, order=3, mode="nearest", cval=0.0, nghost=64, npad=0):
+	"""Helper for interpol. Equivalent to scipy.ndimage.map_coordinates(a,
+	inds, prefilter=False), but with the last axis of a being periodic with
+	a period equal to its length. a must already be prefiltered with
+	interpol_prefilter(..., wrap=True) if order > 1, and npad is the padding
+	it returns. The positions within nghost/2 pixels of the seam are
+	evaluated on a thin ghost array made from the nghost columns on each
+	side of it, so a is not padded in the periodic direction."""
+	a    = np.asarray(a)
+	inds = np.asarray(inds)
+	n    = a.shape[-1]
+	g    = min(nghost, n//2)
+	# Map the periodic coordinate into [0,n)
+	coords = np.empty(inds.shape)
+	coords[:-1] = inds[:-1] + npad
+	coords[-1]  = inds[-1]
+	coords[-1] -= n*np.floor(coords[-1]/n)
+	res  = np.empty(inds.shape[1:], a.dtype)
+	near = (coords[-1] < g/2.) | (coords[-1] >= n-g/2.)
+	far  = ~near
+	if np.any(far):
+		res[far] = scipy.ndimage.map_coordinates(a, coords[:,far], order=order, mode=mode, cval=cval, prefilter=False)
+	if np.any(near):
+		ghost = np.concatenate([a[...,n-g:],a[...,:g]],-1)
+		cnear = coords[:,near]
+		cnear[-1] += np.where(cnear[-1] >= n/2., g-n, g)
+		res[near] = scipy.ndimage.map_coordinates(ghost, cnear, order=order, mode=mode, cval=cval, prefilter=False)
+	return res
+
+def interpol_prefilter(a, npre=None, order=3, inplace=False, wrap=False, nghost=64, mode="mirror", pad=False):
+	"""Spline-prefilter a for use with interpol(..., prefilter=False). The
+	first npre axes (default all but the last two) are not filtered. mode
+	is the boundary condition used for filtering, and should match the mode
+	later passed to interpol. If wrap is True, the last axis is treated as
+	periodic. The coefficients within nghost/2 pixels of its ends are then
+	taken from the filtered ghost array made from the nghost columns on each
+	side of the seam, which makes them accurate to about 0.27**(nghost/2)
+	for cubic splines.
+
+	Like map_coordinates, the array is padded by spline_npad(mode) pixels
+	before filtering. The padding is cut off again unless pad is True, but
+	then the coefficients are only exact from one pixel inside the edges.
+	With pad=True, (coeffs, npad) is returned instead, and coeffs must be
+	evaluated at inds+npad (not shifting the periodic axis if wrap is True)
+	to reproduce interpol(a, inds) exactly."""
 	a = np.asanyarray(a)
-	if not inplace: a = a.copy()
 	if npre is None: npre = a.ndim - 2
-	with flatview(a, range(npre, a.ndim), "rw") as aflat:
-		for i in range(len(aflat)):
-			aflat[i] = scipy.ndimage.spline_filter(aflat[i], order=order)
-	return a
+	npad  = spline_npad(mode)
+	width = [(0,0)]*npre + [(npad,npad)]*(a.ndim-npre)
+	if wrap: width[-1] = (0,0)
+	def filt(x):
+		if npad > 0: x = np.pad(x, width[npre:], mode="edge")
+		res = spline_filter(x, order=order, mode=mode)
+		if wrap:
+			n, g  = x.shape[-1], min(nghost, x.shape[-1]//2)
+			h     = g//2
+			ghost = np.concatenate([x[...,n-g:],x[...,:g]],-1)
+			ghost = spline_filter(ghost, order=order, mode=mode)
+			res[...,n-h:] = ghost[...,g-h:g]
+			res[...,:h]   = ghost[...,g:g+h]
+		if npad > 0 and not pad: res = res[tuple([slice(w1,res.shape[i]-w2) for i,(w1,w2) in enumerate(width[npre:])])]
+		return res
+	if pad and npad > 0:
+		out = np.empty([n+w1+w2 for n,(w1,w2) in zip(a.shape,width)], a.dtype)
+	elif inplace: out = a
+	else: out = a.copy()
+	with flatview(a, range(npre, a.ndim), "r") as aflat:
+		with flatview(out, range(npre, out.ndim), "rw") as oflat:
+			for i in range(len(aflat)):
+				oflat[i].real = filt(aflat[i].real)
+				if np.iscomplexobj(aflat[i]):
+					oflat[i].imag = filt(aflat[i].imag)
+	return (out, npad) if pad else out
+
+def spline_npad(mode):
+	"""The number of pixels map_coordinates pads each side of its input by
+	before spline-filtering it with the given mode. Only scipy >= 1.6 pads,
+	and only for mode "nearest"."""
+	return 12 if mode == "nearest" and scipy_version() >= (1,6) else 0
+
+def spline_filter(a, order=3, mode="mirror"):
+	"""Spline-filter a the way map_coordinates does for the given mode.
+	Older versions of scipy always use mirror boundaries, and before 1.6
+	spline_filter may not accept a mode, so it is only passed when needed."""
+	if mode in ["constant","mirror"] or scipy_version() < (1,6):
+		return scipy.ndimage.spline_filter(a, order=order)
+	return scipy.ndimage.spline_filter(a, order=order, mode=mode)
+
+def scipy_version():
+	"""Returns the (major,minor) version of scipy."""
+	return tuple([int(v) for v in scipy.__version__.split(".")[:2]])
 
 def bin_multi(pix, shape, weights=None):
 	"""Simple multidimensional binning. Not very fast."""
@@ -376,6 +610,49 @@ def mkdir(path):
 		if exception.errno != errno.EEXIST:
 			raise
 
+def cache_dir(subdir=None):
+	"""Return the directory used for on-disk caches, creating it if
+	necessary. This is $LAMBDA_TOOLS_CACHE if set, and otherwise
+	~/.cache/lambda_tools. Returns None if the directory can't be created."""
+	path = os.environ.get("LAMBDA_TOOLS_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "lambda_tools")
+	if subdir: path = os.path.join(path, subdir)
+	try: mkdir(path)
+	except OSError: return None
+	return path
+
+def cache_key(*args):
+	"""Return a hex string that identifies the given arguments, for use as
+	a file name in an on-disk cache. Arrays are identified by their contents,
+	everything else by its string representation."""
+	import hashlib
+	h = hashlib.sha1()
+	for arg in args:
+		if isinstance(arg, np.ndarray):
+			h.update(str((arg.shape, arg.dtype.str)).encode())
+			h.update(np.ascontiguousarray(arg).view(np.uint8))
+		else:
+			h.update(repr(arg).encode())
+		h.update(b"\0")
+	return h.hexdigest()
+
+def cache_evict(path, maxsize):
+	"""Delete the least recently used files in the directory path until
+	their total size is at most maxsize bytes. Use is measured by the
+	modification time, so readers should touch the files they use."""
+	files = []
+	for name in os.listdir(path):
+		fname = os.path.join(path, name)
+		try: stat = os.stat(fname)
+		except OSError: continue
+		files.append((stat.st_mtime, stat.st_size, fname))
+	files.sort()
+	total = sum([f[1] for f in files])
+	for mtime, size, fname in files:
+		if total <= maxsize: break
+		try: os.remove(fname)
+		except OSError: continue
+		total -= size
+
 def decomp_basis(basis, vec):
 	return np.linalg.solve(basis.dot(basis.T),basis.dot(vec.T)).T
 
@@ -695,6 +972,100 @@ def eigsort(A, nmax=None, merged=False):
 	if merged: return V[:,inds]*E[inds][None]**0.5
 	else:      return E[inds],V[:,inds]
 
+def eigpow(A, e, rlim=None, out=None, sepmin=1e-3):
+	"""Raise the stack of real, symmetric matrices A[...,n,n] to the power e
+	in eigen-space. Eigenvalues smaller than rlim times the largest absolute
+	eigenvalue of each matrix are treated as zero, and contribute nothing
+	to the result (so e.g. e=-1 gives a pseudo-inverse). For n <= 3 the
+	eigenvalues are computed in closed form and the result is built with
+	Sylvester's formula. That formula loses accuracy for matrices with
+	eigenvalues closer than sepmin (relative) to each other or smaller than
+	sepmin times the largest one, so those fall back on a stacked eigh, as
+	do all larger matrices."""
+	A = np.asarray(A)
+	n = A.shape[-1]
+	if rlim is None: rlim = 100*np.finfo(float_type(A.dtype)).eps
+	if out is None: out = np.empty(A.shape, float_type(A.dtype))
+	if A.size == 0: return out
+	Af = A.reshape((-1,n,n)).astype(np.float64, copy=False)
+	of = out.reshape((-1,n,n)) if out.flags.c_contiguous else np.empty(Af.shape)
+	if n > 3:
+		of[:] = eigpow_eigh(Af, e, rlim)
+	else:
+		E  = eigvals_sym(Af)
+		# Mark as bad the eigenvalues that would make the power ill-defined
+		emax = np.max(np.abs(E),-1)[:,None]
+		bad  = E <= emax*rlim
+		with np.errstate(all="ignore"):
+			F = np.where(bad, 0, np.abs(E)**e)
+		# Check for degeneracies and poor conditioning
+		ok = np.all(np.abs(E) > emax*sepmin,-1)
+		for i in range(n):
+			for j in range(i+1,n):
+				sep = np.abs(E[:,i]-E[:,j])
+				ok &= sep > sepmin*np.maximum(np.abs(E[:,i]),np.abs(E[:,j]))
+		if n == 1:
+			of[:,0,0] = F[:,0]
+		else:
+			# Sylvester's formula: f(A) = sum_i f_i prod_{j!=i} (A-l_j)/(l_i-l_j).
+			# We write this as c0 + c1 A + c2 A**2.
+			c  = np.zeros((3,len(Af)))
+			with np.errstate(all="ignore"):
+				for i in range(n):
+					others = [j for j in range(n) if j != i]
+					D = np.prod([E[:,i]-E[:,j] for j in others],0)
+					if n == 2:
+						c[0] -= F[:,i]*E[:,others[0]]/D
+						c[1] += F[:,i]/D
+					else:
+						lj, lk = E[:,others[0]], E[:,others[1]]
+						c[0] += F[:,i]*lj*lk/D
+						c[1] -= F[:,i]*(lj+lk)/D
+						c[2] += F[:,i]/D
+				of[:] = c[1,:,None,None]*Af
+				if n == 3: of += c[2,:,None,None]*np.einsum("aij,ajk->aik", Af, Af)
+				for i in range(n): of[:,i,i] += c[0]
+		if not np.all(ok):
+			of[~ok] = eigpow_eigh(Af[~ok], e, rlim)
+	if of is not out: out[...] = of.reshape(out.shape)
+	return out
+
+def eigvals_sym(A):
+	"""Closed-form eigenvalues of the stack of real, symmetric matrices A[N,n,n],
+	for n <= 3. Returns E[N,n]."""
+	n = A.shape[-1]
+	if n == 1: return A[:,:,0].copy()
+	if n == 2:
+		m = 0.5*(A[:,0,0]+A[:,1,1])
+		d = (0.25*(A[:,0,0]-A[:,1,1])**2 + A[:,0,1]**2)**0.5
+		# Get the smaller eigenvalue from the determinant to avoid cancellation
+		l1 = m + np.where(m >= 0, d, -d)
+		with np.errstate(all="ignore"):
+			l2 = np.where(l1 != 0, (A[:,0,0]*A[:,1,1]-A[:,0,1]**2)/l1, 0)
+		return np.array([l1,l2]).T
+	if n == 3:
+		# Trigonometric solution of the characteristic polynomial
+		q  = np.trace(A, axis1=1, axis2=2)/3
+		p1 = A[:,0,1]**2 + A[:,0,2]**2 + A[:,1,2]**2
+		p2 = (A[:,0,0]-q)**2 + (A[:,1,1]-q)**2 + (A[:,2,2]-q)**2 + 2*p1
+		p  = (p2/6)**0.5
+		ps = np.where(p > 0, p, 1)
+		B  = (A - q[:,None,None]*np.eye(3))/ps[:,None,None]
+		r  = np.clip(np.linalg.det(B)/2, -1, 1)
+		phi= np.arccos(r)/3
+		l1 = q + 2*p*np.cos(phi)
+		l3 = q + 2*p*np.cos(phi+2*np.pi/3)
+		return np.array([l1, 3*q-l1-l3, l3]).T
+	raise ValueError("eigvals_sym only supports n <= 3")
+
+def eigpow_eigh(A, e, rlim):
+	"""Helper for eigpow. Computes A[N,n,n]**e using a stacked eigh."""
+	E, V = np.linalg.eigh(A)
+	bad  = E <= np.max(np.abs(E),-1)[:,None]*rlim
+	with np.errstate(all="ignore"):
+		F = np.where(bad, 0, np.abs(E)**e)
+	return np.einsum("aij,aj,akj->aik", V, F, V)
+
 def nodiag(A):
 	"""Returns matrix A with its diagonal set to zero."""
 	A = np.array(A)
@@ -1026,28 +1397,32 @@ def split_slice(sel, ndims):
 	indices to allocate to each split, starting from the left. Also expands all
 	ellipsis."""
 	if not isinstance(sel,tuple): sel = (sel,)
-	# We know the total number of dimensions involved, so we can expand ellipis
-	# What the heck? "in" operator is apparently broken for lists that
-	# contain numpy arrays.
-	parts = listsplit(sel, Ellipsis)
-	if len(parts) > 1:
+	# We know the total number of dimensions involved, so we can expand ellipis.
+	# Compare by identity, since == misbehaves for numpy arrays.
+	inds = [i for i,v in enumerate(sel) if v is Ellipsis]
+	if len(inds) > 0:
 		# Only the rightmost ellipsis has any effect
-		left, right = sum(parts[:-1],()), parts[-1]
+		left  = tuple([v for v in sel[:inds[-1]] if v is not Ellipsis])
+		right = sel[inds[-1]+1:]
 		nfree = sum(ndims) - sum([i is not None for i in (left+right)])
 		sel = left + tuple([slice(None) for i in range(nfree)]) + right
 	return split_slice_simple(sel, ndims)
 
 def split_slice_simple(sel, ndims):
 	"""Helper function for split_slice. Splits a slice
-	in the absence of ellipsis."""
-	res = [[] for n in ndims]
-	notNone = [v is not None for v in sel]
-	subs = np.concatenate([[0],cumsplit(notNone, ndims)])
-	for i, r in enumerate(res):
-		r += sel[subs[i]:subs[i+1]]
-	if subs[i+1] < len(sel):
+	in the absence of ellipsis. None-indices following the
+	last index of a split are assigned to that split."""
+	res, i = [], 0
+	for ndim in ndims:
+		j, n = i, 0
+		while j < len(sel) and (n < ndim or sel[j] is None):
+			if sel[j] is not None: n += 1
+			j += 1
+		res.append(tuple(sel[i:j]))
+		i = j
+	if i < len(sel):
 		raise IndexError("Too many indices")
-	return [tuple(v) for v in res]
+	return res
 
 def parse_slice(desc):
 	class Foo:
@@ -1067,6 +1442,72 @@ def slice_downgrade(d, s, axis=-1):
 	a = np.mean(a.reshape((len(a)/step,step)+a.shape[1:]),1)
 	return moveaxis(a, 0, axis)
 
+def get_nthread(nthread=None):
+	"""Return the number of threads to use for threaded operations. If nthread
+	is not specified, it is read from the OMP_NUM_THREADS environment
+	variable, falling back on the number of cores."""
+	if nthread: return int(nthread)
+	try: return int(os.environ["OMP_NUM_THREADS"])
+	except (KeyError, ValueError):
+		import multiprocessing
+		return multiprocessing.cpu_count()
+
+def threaded_map(fun, args, nthread=None):
+	"""Equivalent to [fun(a) for a in args], but with the calls distributed
+	over a pool of nthread threads. This is only useful when fun spends most
+	of its time in code that releases the GIL, like large numpy operations."""
+	args    = list(args)
+	nthread = min(get_nthread(nthread), len(args))
+	if nthread <= 1: return [fun(a) for a in args]
+	from multiprocessing.pool import ThreadPool
+	pool = ThreadPool(nthread)
+	try: return pool.map(fun, args)
+	finally: pool.close()
+
+class lrucache:
+	"""A dictionary-like cache holding at most maxsize items, where the
+	least recently used items are discarded first. Use as
+	val = cache.get(key, fun), which returns the cached value for key
+	or stores and returns fun() if missing. If maxbytes is specified,
+	items are also discarded until the arrays held by the cache take up
+	at most that many bytes in total. Values larger than maxbytes are
+	returned but not stored."""
+	def __init__(self, maxsize=16, maxbytes=None):
+		import collections
+		self.maxsize = maxsize
+		self.maxbytes= maxbytes
+		self.data    = collections.OrderedDict()
+		self.sizes   = {}
+	def get(self, key, fun=None):
+		if key in self.data:
+			val = self.data.pop(key)
+		elif fun is None: raise KeyError(key)
+		else:
+			val = fun()
+			self.sizes[key] = nbytes(val)
+			if self.maxbytes is not None and self.sizes[key] > self.maxbytes:
+				del self.sizes[key]
+				return val
+		self.data[key] = val
+		while len(self.data) > self.maxsize or self.maxbytes is not None and self.nbytes > self.maxbytes:
+			del self.sizes[self.data.popitem(last=False)[0]]
+		return val
+	@property
+	def nbytes(self): return sum(self.sizes.values())
+	def __contains__(self, key): return key in self.data
+	def __len__(self): return len(self.data)
+	def clear(self):
+		self.data.clear()
+		self.sizes.clear()
+
+def nbytes(val):
+	"""Return the total number of bytes used by the numpy arrays in val,
+	which can be an array or a (nested) tuple or list of them. Other
+	objects count as zero bytes."""
+	if isinstance(val, np.ndarray): return val.nbytes
+	if isinstance(val, (tuple,list)): return sum([nbytes(v) for v in val])
+	return 0
+
 class Printer:
 	def __init__(self, level=1, prefix=""):
 		self.level  = level
@@ -4,9 +4,12 @@ the same ordering as WCS, i.e. column major (so {ra,dec} rather than
 {dec,ra}). Coordinates are assigned to pixel centers, as WCS does natively,
 but bounding boxes include the whole pixels, not just their centers, which
 is where the 0.5 stuff comes from."""
-import numpy as np
-from astropy.wcs import WCS
+import numpy as np, sys
 from . import utils
+# Add our describe to all WCSes once astropy.wcs is imported. WCS
+# is astropy.wcs.WCS, but is only looked up when first used.
+awcs = utils.lazy_module("astropy.wcs", onload=lambda mod: setattr(mod.WCS, "__repr__", describe))
+WCS  = utils.lazy_class(awcs, "WCS")
 
 # The origin argument used in the wcs pix<->world routines seems to
 # have to be 1 rather than the 0 one would expect. For example,
@@ -49,14 +52,64 @@ def describe(wcs):
 	for p in pv:
 		fields += ",pv[%d,%d]=%.3g" % p
 	return "%s:{%s}" % (sys, fields)
-# Add this to all WCSes in this class
-WCS.__repr__ = describe
+
+# If astropy.wcs is already in use, patch it right away
+if "astropy.wcs" in sys.modules: awcs._load()
 
 def is_plain(wcs):
 	"""Determines whether the given wcs represents plain, non-specific,
 	non-wrapping coordinates or some angular coordiante system."""
 	return wcs.wcs.ctype[0] == ""
 
+def native_params(wcs):
+	"""Returns the parameters needed to evaluate the projection of wcs in
+	closed form with world2pix_native, or None if wcs is not one of the
+	simple cases handled there: plain coordinates, or CAR or CEA with the
+	reference point on the equator and no rotation. These are the ones
+	built by plain, car and cea."""
+	w = wcs.wcs
+	if w.naxis != 2 or w.has_cd() or np.any(w.get_pc() != np.eye(2)): return None
+	ctype = list(w.ctype)
+	if ctype == ["",""]: proj, lam = "plain", 1.0
+	elif ctype in [["RA---CAR","DEC--CAR"],["RA---CEA","DEC--CEA"]]:
+		if w.crval[1] != 0 or w.lonpole != 0: return None
+		proj, lam = ctype[0][-3:].lower(), 1.0
+		for i, m, v in w.get_pv():
+			if proj == "cea" and (i,m) == (2,1): lam = v
+			else: return None
+	else: return None
+	# Use zero-based reference pixels
+	return proj, np.array(w.crval), np.array(w.cdelt), np.array(w.crpix)-1, lam
+
+def world2pix_native(params, world, out=None, wrap=True):
+	"""Closed-form world to zero-based pixel coordinate transformation for
+	the simple projections described by params (from native_params).
+	world is [{lon,lat},...] in degrees. Returns pix[{x,y},...], which
+	is written to out if specified. out may be world itself. If wrap is
+	False, the longitude is not wrapped into [-180,180) around crval,
+	which is useful if the caller does its own wrapping."""
+	proj, crval, cdelt, crpix, lam = params
+	world = np.asarray(world)
+	if out is None: out = np.empty(world.shape)
+	if proj == "plain":
+		np.subtract(world[0], crval[0], out[0])
+		np.subtract(world[1], crval[1], out[1])
+	else:
+		if wrap:
+			np.subtract(world[0], crval[0]-180, out[0])
+			out[0] %= 360
+			out[0] -= 180
+		else: np.subtract(world[0], crval[0], out[0])
+		if proj == "car": out[1] = world[1]
+		else:
+			np.multiply(world[1], deg2rad, out[1])
+			np.sin(out[1], out[1])
+			out[1] *= rad2deg/lam
+	for i in range(2):
+		out[i] *= 1/cdelt[i]
+		out[i] += crpix[i]
+	return out
+
 def scale(wcs, scale=1, rowmajor=False):
 	"""Scales the linear pixel sensity of a wcs by the given factor, which can be specified
 	per axis. This is the same as dividing the pixel size by the same number."""